@@ -0,0 +1,62 @@
+"""
+Sweeps the batch size of the cross-scene cloud model pass and reports tiles/s for each, to pick
+CLOUD_MASK_BATCH_SIZE for a given vCPU count. Uses a randomly initialised UNet with the
+production architecture over synthetic stacks.
+
+    python -m benchmarks.bench_batch_inference --scenes 8 --size 2048 --threads 2 4 --batch-sizes 1 2 4 8
+"""
+
+import argparse
+import tempfile
+import time
+import torch
+
+from benchmarks.bench_cloud_mask import create_model, create_stack
+from common.constants import CLOUD_MASK_TILE_OVERLAP, CLOUD_MASK_TILE_SIZE
+from common.utilities.masking import predict_nn_cloud_masks
+from common.utilities.tiling import get_tile_windows
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenes', type=int, default=8)
+    parser.add_argument('--size', type=int, default=2048, help='stack width and height in pixels')
+    parser.add_argument('--tile-size', type=int, default=CLOUD_MASK_TILE_SIZE)
+    parser.add_argument('--overlap', type=int, default=CLOUD_MASK_TILE_OVERLAP)
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()], help='torch intra-op threads, match the task vCPUs')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root_dir:
+
+        model_path = create_model(f'{root_dir}/cloud_model.pth')
+        stack_tif_paths = {
+            scene: create_stack(f'{root_dir}/stack_{scene}.tif', args.size, seed=scene)
+            for scene in range(args.scenes)
+        }
+        tile_count = args.scenes * len(list(get_tile_windows(args.size, args.size, args.tile_size)))
+
+        # warm up the model registry and allocator so the first batch size isn't penalised
+        predict_nn_cloud_masks({0: stack_tif_paths[0]}, model_path, args.tile_size, args.overlap, batch_size=1)
+
+        print(f'{args.scenes} scenes of {args.size} x {args.size} px, {tile_count} tiles of {args.tile_size} px')
+        print(f'{"threads":>8} {"batch":>6} {"seconds":>9} {"tiles/s":>8}')
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+
+            results = []
+            for batch_size in args.batch_sizes:
+                start_time = time.time()
+                predict_nn_cloud_masks(stack_tif_paths, model_path, args.tile_size, args.overlap, batch_size=batch_size)
+                elapsed = time.time() - start_time
+
+                results.append((tile_count / elapsed, batch_size))
+                print(f'{threads:>8} {batch_size:>6} {elapsed:>9.2f} {tile_count / elapsed:>8.2f}')
+
+            best_rate, best_batch_size = max(results)
+            print(f'best batch size with {threads} threads: {best_batch_size} ({best_rate:.2f} tiles/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Reports peak RSS and throughput of apply_cloud_mask across AOI sizes and tile sizes.
+Each run happens in a fresh process so its peak RSS is its own. Uses a randomly
+initialised UNet with the production architecture, so timings are representative
+but the masks are not.
+
+    python -m benchmarks.bench_cloud_mask --sizes 1024 2048 4096 --tile-sizes 512 1024 0
+
+A tile size of 0 processes the whole stack as one tile, which is how masking used to work.
+"""
+
+import argparse
+import multiprocessing
+import numpy as np
+import tempfile
+import time
+
+from common.utilities.profiling import get_peak_rss_bytes
+
+
+META = {'AZIMUTH_ANGLE': 130.0, 'ZENITH_ANGLE': 35.0}
+
+
+def create_model(model_path, in_channels=4, classes=1, encoder='resnet18', bias=None):
+
+    import segmentation_models_pytorch as smp
+    import torch
+
+    model = smp.Unet(encoder, encoder_weights=None, in_channels=in_channels, classes=classes)
+    if bias is not None:
+        # push the random logits one way, so a cloud model doesn't mask whole scenes
+        torch.nn.init.constant_(model.segmentation_head[0].bias, bias)
+    torch.save(model, model_path)
+    return model_path
+
+
+def create_stack(stack_path, size, bands=5, seed=0):
+
+    from common.utilities.imagery import write_array_to_tif
+
+    rng = np.random.default_rng(seed)
+    stack_data = rng.random((size, size, bands), dtype=np.float32)
+    stack_data[:, :, -1] = rng.choice([4, 5, 8, 9], size=(size, size), p=[0.6, 0.3, 0.05, 0.05])
+    write_array_to_tif(stack_data, stack_path, [30.0, -1.0 - size * 9e-5, 30.0 + size * 9e-5, -1.0])
+    return stack_path
+
+
+def run(stack_path, dst_path, model_path, tile_size, queue):
+
+    from common.utilities.masking import apply_cloud_mask
+
+    start_time = time.time()
+    apply_cloud_mask(stack_path, META, dst_path, model_path, tile_size=tile_size)
+    queue.put((time.time() - start_time, get_peak_rss_bytes()))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048, 4096], help='AOI width and height in pixels')
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=[512, 1024, 0])
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as root_dir:
+
+        model_path = create_model(f'{root_dir}/cloud_model.pth')
+
+        print(f'{"aoi px":>8} {"tile px":>8} {"seconds":>9} {"Mpx/s":>7} {"peak RSS MB":>12}')
+        for size in args.sizes:
+            stack_path = create_stack(f'{root_dir}/stack_{size}.tif', size)
+
+            for tile_size in args.tile_sizes:
+                queue = context.Queue()
+                process = context.Process(target=run, args=(stack_path, f'{root_dir}/masked.tif', model_path, tile_size or size, queue))
+                process.start()
+                elapsed, peak_rss = queue.get()
+                process.join()
+
+                print(f'{size:>8} {tile_size or size:>8} {elapsed:>9.2f} {size * size / elapsed / 1e6:>7.2f} {peak_rss / 1e6:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Compares the streamed merge_scenes with the old pair of whole-mosaic rasterio.merge.merge calls
+on synthetic masked scenes with offset grids. Checks the composites are identical and reports
+wall time and peak RSS, each run in a fresh process.
+
+    python -m benchmarks.bench_composite --scenes 8 --size 4096 --block-rows 256 512 1024
+"""
+
+import argparse
+import multiprocessing
+import numpy as np
+import rasterio
+import rasterio.merge
+import tempfile
+import time
+
+from common.constants import NODATA_FLOAT32
+from common.utilities.imagery import merge_scenes, write_array_to_tif
+from common.utilities.profiling import get_peak_rss_bytes
+
+
+def create_scenes(root_dir, count, size, seed=0):
+
+    rng = np.random.default_rng(seed)
+    res = 10 / (111.32 * 1000)
+
+    scenes = {}
+    for i in range(count):
+        # each scene is offset by a fraction of a pixel, like scenes clipped from different tiles
+        left = 30.0 + rng.random() * size * res * 0.1
+        top = -1.0 - rng.random() * size * res * 0.1
+        transform = rasterio.transform.from_origin(left, top, res, res)
+
+        data = rng.random((size, size, 4), dtype=np.float32)
+        data = np.ma.array(data, mask=(rng.random((size, size, 1)) < 0.3).repeat(4, axis=2))
+
+        scenes[f'scene_{i}'] = f'{root_dir}/stack_masked_{i}.tif'
+        write_array_to_tif(data, scenes[f'scene_{i}'], None, transform=transform)
+
+    return scenes
+
+
+def merge_scenes_legacy(scenes_dict, merged_path):
+
+    masked_sources = [rasterio.open(path) for path in scenes_dict.values()]
+
+    sum_data, sum_transform = rasterio.merge.merge(masked_sources, indexes=[1, 2, 3, 4], method="sum", nodata=NODATA_FLOAT32)
+    sum_data = np.ma.array(sum_data, mask=(sum_data==NODATA_FLOAT32))
+
+    count_data, count_transform = rasterio.merge.merge(masked_sources, indexes=[1, 2, 3, 4], method="count", nodata=NODATA_FLOAT32)
+    count_data = np.ma.array(count_data, mask=(count_data==NODATA_FLOAT32))
+
+    mean_data = sum_data / count_data
+    mean_data = mean_data.transpose((1, 2, 0))
+
+    write_array_to_tif(mean_data, merged_path, None, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32, transform=sum_transform)
+
+
+def run(scenes, merged_path, block_rows, queue):
+
+    start_time = time.time()
+    if block_rows:
+        merge_scenes(scenes, merged_path, block_rows=block_rows)
+    else:
+        merge_scenes_legacy(scenes, merged_path)
+    queue.put((time.time() - start_time, get_peak_rss_bytes()))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenes', type=int, default=8)
+    parser.add_argument('--size', type=int, default=4096, help='scene width and height in pixels')
+    parser.add_argument('--block-rows', type=int, nargs='+', default=[256, 512, 1024])
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        scenes = create_scenes(root_dir, args.scenes, args.size)
+
+        print(f'{args.scenes} scenes of {args.size} x {args.size} px')
+        print(f'{"version":<16} {"seconds":>8} {"peak RSS MB":>12} {"identical":>10}')
+
+        reference = None
+        for block_rows in [0] + args.block_rows:
+            merged_path = f'{root_dir}/composite_{block_rows}.tif'
+
+            queue = context.Queue()
+            process = context.Process(target=run, args=(scenes, merged_path, block_rows, queue))
+            process.start()
+            elapsed, peak_rss = queue.get()
+            process.join()
+
+            with rasterio.open(merged_path) as src:
+                composite = src.read()
+            if reference is None:
+                reference = composite
+
+            name = f'{block_rows} row blocks' if block_rows else 'legacy'
+            print(f'{name:<16} {elapsed:>8.2f} {peak_rss / 1e6:>12.0f} {str(np.array_equal(reference, composite)):>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Compares morphology.dilate with scipy's maximum_filter on the circular buffer footprint across
+footprint sizes and mask sizes. Checks the masks are identical and reports wall time.
+
+    python -m benchmarks.bench_dilation --sizes 1024 4096 --footprint-sizes 10 20 40
+"""
+
+import argparse
+import numpy as np
+from scipy.ndimage import binary_dilation, maximum_filter
+import time
+
+from common.utilities import masking
+from common.utilities.morphology import dilate
+
+
+def measure(func, repeats):
+
+    timings = []
+    for _ in range(repeats):
+        start_time = time.time()
+        result = func()
+        timings.append(time.time() - start_time)
+
+    return result, min(timings)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 4096], help='mask width and height in pixels')
+    parser.add_argument('--footprint-sizes', type=int, nargs='+', default=[10, 20, 40], help='20 is CLOUD_MASK_BUFFER_SIZE')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"mask px":>8} {"footprint":>10} {"maximum_filter s":>17} {"dilate s":>9} {"speedup":>8} {"identical":>10}')
+    for size in args.sizes:
+
+        # scattered clumps, like clouds and bad pixels
+        rng = np.random.default_rng(0)
+        mask = binary_dilation(rng.random((size, size)) < 0.001, iterations=3)
+
+        for footprint_size in args.footprint_sizes:
+            footprint = masking.__get_circular_mask(footprint_size)
+
+            expected, filter_secs = measure(lambda: maximum_filter(mask, footprint=footprint, mode='constant', cval=0), args.repeats)
+            result, dilate_secs = measure(lambda: dilate(mask, footprint), args.repeats)
+            identical = np.array_equal(expected, result)
+
+            print(f'{size:>8} {footprint_size:>10} {filter_secs:>17.3f} {dilate_secs:>9.3f} {filter_secs / dilate_secs:>7.1f}x {str(identical):>10}')
+
+
+if __name__ == '__main__':
+    main()
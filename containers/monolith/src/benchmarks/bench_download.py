@@ -0,0 +1,71 @@
+"""
+Measures download_collection against synthetic COGs served by a throttled local HTTP server,
+so the effect of concurrent band reads can be compared without network access.
+
+    python -m benchmarks.bench_download --scenes 10 --latency 0.05 --workers 1 4 16
+"""
+
+import argparse
+import os
+from pystac import ItemCollection
+from shapely.geometry import box, shape
+import tempfile
+import time
+
+from benchmarks.fixtures import create_scene_fixture, get_served_items, serve_directory
+from common.constants import S2_BANDS_TIFF_ORDER
+from common.utilities.download import download_collection
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenes', type=int, default=10)
+    parser.add_argument('--size', type=int, default=1024, help='scene width and height in 10 m pixels')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every HTTP request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second per connection')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    # don't let GDAL list the fixture directory on every open
+    os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+
+    res = 10 / (111.32 * 1000)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+
+        fixtures_dir = f'{root_dir}/fixtures'
+        items = [
+            create_scene_fixture(fixtures_dir, f'S2B_35MRU_202301{i + 1:02d}_0_L2A', size=args.size, seed=i)
+            for i in range(args.scenes)
+        ]
+
+        # a bbox over the middle of the scenes so every read is a real window
+        scene_poly_ll = shape(items[0].geometry)
+        xmin, ymin, xmax, ymax = scene_poly_ll.bounds
+        dx, dy = (xmax - xmin) / 4, (ymax - ymin) / 4
+        bbox = box(xmin + dx, ymin + dy, xmax - dx, ymax - dy).bounds
+
+        results = {}
+        for workers in args.workers:
+
+            dst_dir = f'{root_dir}/workers_{workers}'
+            os.makedirs(dst_dir)
+
+            with serve_directory(fixtures_dir, latency=args.latency, bandwidth=args.bandwidth) as base_url:
+                collection = ItemCollection(items=get_served_items(items, base_url))
+
+                start_time = time.time()
+                scenes = download_collection(collection, bbox, S2_BANDS_TIFF_ORDER, dst_dir, res, max_workers=workers)
+                results[workers] = (time.time() - start_time, scenes)
+
+        print()
+        print(f'{args.scenes} scenes x {len(S2_BANDS_TIFF_ORDER)} bands, {args.latency * 1000:.0f} ms latency')
+        baseline = results[args.workers[0]][0]
+        for workers, (elapsed, scenes) in results.items():
+            mean_scene = sum(s['timings']['download'] for s in scenes.values()) / len(scenes)
+            print(f'workers={workers:<4} total={elapsed:7.2f}s  mean scene download={mean_scene:6.2f}s  speedup={baseline / elapsed:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Reports how the median compositor scales with worker count and scene count against the old
+single-core version, and checks the composites are identical. With --kernels it also times
+imagery.get_nan_median on one block against np.nanmedian and a np.partition version.
+
+    python -m benchmarks.bench_median --size 2048 --scenes 4 8 16 --workers 1 2 4
+    python -m benchmarks.bench_median --size 1024 --scenes 3 6 10 20 --kernels
+"""
+
+import argparse
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import tempfile
+import time
+
+from common.constants import NODATA_FLOAT32
+from common.utilities.imagery import create_composite_from_paths, get_nan_median, write_array_to_tif
+
+
+def create_stacks(root_dir, count, size, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    stack_paths = []
+    for i in range(count):
+        data = rng.random((size, size, 4), dtype=np.float32)
+        data = np.ma.array(data, mask=(rng.random((size, size, 1)) < 0.3).repeat(4, axis=2))
+
+        stack_paths.append(f'{root_dir}/stack_{i}.tif')
+        write_array_to_tif(data, stack_paths[-1], [30.0, -1.0 - size * 9e-5, 30.0 + size * 9e-5, -1.0])
+
+    return stack_paths
+
+
+def create_composite_from_paths_legacy(stack_paths, dst_path, nodata=NODATA_FLOAT32):
+
+    with rasterio.open(stack_paths[0]) as src:
+        band_count = src.count
+        meta = src.meta.copy()
+        nrows, ncols = src.height, src.width
+
+    with rasterio.open(dst_path, 'w', **meta) as dst:
+        batch_size = 1600
+        for row in np.arange(0, nrows, batch_size):
+            bsize = nrows - row if row + batch_size > nrows else batch_size
+            window = Window(0, row, ncols, bsize)
+
+            batch_data = []
+            for path in stack_paths:
+                with rasterio.open(path) as src:
+                    data = src.read(masked=True, window=window)
+                    data[data.mask] = np.nan
+                    batch_data.append(data)
+
+            batch_centre = np.nanmedian(np.array(batch_data), axis=0)
+
+            for i in range(band_count):
+                dst.write(np.nan_to_num(batch_centre[i, :, :], nan=nodata), indexes=i+1, window=window)
+
+
+def get_nan_median_partition(data):
+
+    # partitions each valid count's pixels on their middle entries instead of sorting them all
+    valid_count = data.shape[0] - np.isnan(data).sum(axis=0)
+    median = np.full(data.shape[1:], np.nan, dtype=data.dtype)
+    for count in np.unique(valid_count[valid_count > 0]):
+        pixels = valid_count == count
+        values = data[:, pixels]
+        middle = sorted({(count - 1) // 2, count // 2})
+        values.partition(middle, axis=0)
+        median[pixels] = (values[middle[0]] + values[middle[-1]]) / np.float32(2)
+
+    return median
+
+
+def compare_kernels(scene_counts, size, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    print(f'{size} x {size} px block, 4 bands')
+    print(f'{"scenes":>7} {"nanmedian":>10} {"sort":>8} {"partition":>10} {"identical":>10}')
+    for scene_count in scene_counts:
+        block = rng.random((scene_count, 4, size, size), dtype=np.float32)
+        block[rng.random(block.shape) < 0.3] = np.nan
+
+        timings, medians = [], []
+        for func in (lambda data: np.nanmedian(data, axis=0), get_nan_median, get_nan_median_partition):
+            data = block.copy()
+            start_time = time.time()
+            medians.append(func(data))
+            timings.append(time.time() - start_time)
+
+        identical = all(np.array_equal(medians[0], median, equal_nan=True) for median in medians[1:])
+        print(f'{scene_count:>7} {timings[0]:>10.2f} {timings[1]:>8.2f} {timings[2]:>10.2f} {str(identical):>10}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2048, help='stack width and height in pixels')
+    parser.add_argument('--scenes', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--kernels', action='store_true', help='only time the per-block median kernels')
+    args = parser.parse_args()
+
+    if args.kernels:
+        compare_kernels(args.scenes, args.size)
+        return
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        all_stack_paths = create_stacks(root_dir, max(args.scenes), args.size)
+
+        print(f'{args.size} x {args.size} px stacks')
+        print(f'{"scenes":>7} {"workers":>8} {"seconds":>8} {"speedup":>8} {"identical":>10}')
+        for scene_count in args.scenes:
+            stack_paths = all_stack_paths[:scene_count]
+
+            legacy_path = f'{root_dir}/composite_legacy.tif'
+            start_time = time.time()
+            create_composite_from_paths_legacy(stack_paths, legacy_path)
+            legacy_secs = time.time() - start_time
+            print(f'{scene_count:>7} {"legacy":>8} {legacy_secs:>8.2f}')
+
+            with rasterio.open(legacy_path) as src:
+                reference = src.read()
+
+            for workers in args.workers:
+                composite_path = f'{root_dir}/composite_{workers}.tif'
+                start_time = time.time()
+                create_composite_from_paths(stack_paths, composite_path, max_workers=workers)
+                elapsed = time.time() - start_time
+
+                with rasterio.open(composite_path) as src:
+                    identical = np.array_equal(reference, src.read())
+
+                print(f'{scene_count:>7} {workers:>8} {elapsed:>8.2f} {legacy_secs / elapsed:>7.2f}x {str(identical):>10}')
+
+
+if __name__ == '__main__':
+    main()
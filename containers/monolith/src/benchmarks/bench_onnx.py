@@ -0,0 +1,81 @@
+"""
+Compares the onnx backend with the torch backend for a model: largest logit difference and
+mask or class map agreement on fixture chips, median latency, and cold start measured as import
+plus first prediction in a fresh interpreter. Exports the model first if it hasn't been.
+
+    python -m benchmarks.bench_onnx --model common/models/cloud_detection_model_resnet18_dice_20230327.pth --tifs <stack_original.tif ...>
+"""
+
+import argparse
+import numpy as np
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.eval_precision import get_chips, get_class_map
+from common.utilities.models import export_onnx, get_onnx_path, predict
+
+
+COLD_START = '''
+import numpy as np, sys, time
+start_time = time.time()
+from common.utilities.models import predict
+predict(sys.argv[1], np.zeros((1, int(sys.argv[3]), 256, 256), dtype=np.float32), backend=sys.argv[2])
+print(time.time() - start_time)
+'''
+
+
+def get_cold_start_secs(model_path, backend, channels):
+
+    output = subprocess.check_output([sys.executable, '-c', COLD_START, model_path, backend, str(channels)], text=True)
+    return float(output.split()[-1])
+
+
+def run(model_path, chips, backend):
+
+    predict(model_path, chips[:1], backend=backend) # load and warm up
+
+    logits, timings = [], []
+    for chip in chips:
+        start_time = time.time()
+        logits.append(predict(model_path, chip[None], backend=backend))
+        timings.append(time.time() - start_time)
+
+    return np.concatenate(logits), np.median(timings)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, help='path to the .pth model')
+    parser.add_argument('--tifs', nargs='*', default=[], help='stacks or composites to cut chips from')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--chip-size', type=int, default=256)
+    parser.add_argument('--chips', type=int, default=16)
+    parser.add_argument('--atol', type=float, default=1e-3, help='largest accepted logit difference')
+    args = parser.parse_args()
+
+    if not os.path.exists(get_onnx_path(args.model)):
+        export_onnx(args.model)
+
+    chips = get_chips(args.tifs, args.channels, args.chip_size, args.chips)
+
+    results = {}
+    for backend in ['torch', 'onnx']:
+        cold_start = get_cold_start_secs(args.model, backend, args.channels)
+        logits, latency = run(args.model, chips, backend)
+        results[backend] = (logits, latency, cold_start)
+
+    max_diff = np.abs(results['torch'][0] - results['onnx'][0]).max()
+    agreement = np.mean(get_class_map(results['torch'][0]) == get_class_map(results['onnx'][0]))
+
+    print(f'{len(chips)} chips of {args.chip_size} px')
+    print(f'max logit difference {max_diff:.2e} ({"within" if max_diff <= args.atol else "OUTSIDE"} {args.atol}), agreement {agreement:.5f}')
+    print(f'{"backend":<8} {"ms/chip":>8} {"cold start s":>13}')
+    for backend, (_, latency, cold_start) in results.items():
+        print(f'{backend:<8} {latency * 1000:>8.1f} {cold_start:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
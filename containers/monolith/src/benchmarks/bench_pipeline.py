@@ -0,0 +1,221 @@
+"""
+Times every stage of handler.handle end to end on synthetic Sentinel-2 scenes served from a
+throttled local HTTP server and a recorded STAC catalog, and records each stage's peak RSS.
+Results are compared with the baselines stored for the same scene count and size, and the run
+exits with status 1 when a stage got slower or bigger than the tolerances allow, or when there
+is no baseline to compare with. Models have random weights, so timings are representative and
+outputs are not.
+
+    python -m benchmarks.bench_pipeline --scenes 4 --size 1024
+    python -m benchmarks.bench_pipeline --scenes 4 --size 1024 --update-baselines
+
+Tiles are written to disk, or streamed to --s3-bucket as the handler does when one is given. The S3
+upload stage only runs with --s3-bucket, against that bucket.
+"""
+
+import argparse
+from datetime import datetime as dt
+from datetime import timedelta as td
+import json
+import os
+from shapely.geometry import box, shape
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_cloud_mask import create_model
+from benchmarks.fixtures import RecordedCatalogClient, create_scene_fixture, get_served_items, serve_directory
+from common.constants import S2_BANDS_TIFF_ORDER
+from common.utilities import stac
+from common.utilities.download import download_collection, get_cloud_freeish_collection
+from common.utilities.imagery import create_rgb_byte_tifs_from_composite, create_rgb_byte_tifs_from_landcover, merge_scenes
+from common.utilities.masking import apply_cloud_mask, predict_nn_cloud_masks
+from common.utilities.prediction import apply_landcover_classification
+from common.utilities.profiling import track_peak_rss
+from common.utilities.tiles import create_map_tiles
+from common.utilities.upload import create_task_tiles_on_s3, save_task_file_to_s3
+
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'baselines', 'pipeline.json')
+
+STAGES = [
+    'get_cloud_freeish_collection',
+    'download_collection',
+    'apply_cloud_mask',
+    'merge_scenes',
+    'create_rgb_byte_tifs_from_composite',
+    'create_map_tiles',
+    'create_task_tiles_on_s3',
+    'apply_landcover_classification',
+    'create_rgb_byte_tifs_from_landcover',
+    's3_upload',
+]
+
+
+def run_stage(results, name, func, *args, **kwargs):
+
+    print(f'--- {name}')
+    with track_peak_rss() as rss:
+        start_time = time.time()
+        result = func(*args, **kwargs)
+        elapsed = time.time() - start_time
+
+    results[name] = {'seconds': round(elapsed, 3), 'peak_rss_mb': round(rss['peak_rss_bytes'] / 1e6, 1)}
+    return result
+
+
+def mask_scenes(scenes, dst_dir, cloud_model_path):
+
+    # the masking half of get_processed_composite
+    nn_cloud_mask_paths = predict_nn_cloud_masks({scene: scenes[scene]['stack_original_tif_path'] for scene in scenes}, cloud_model_path)
+
+    masked_scenes = {}
+    for scene in scenes:
+        stack_masked_tif_path = f'{dst_dir}/{scene}/stack_masked.tif'
+        if apply_cloud_mask(scenes[scene]['stack_original_tif_path'], scenes[scene]['meta'], stack_masked_tif_path, cloud_model_path, nn_cloud_mask_path=nn_cloud_mask_paths[scene]):
+            masked_scenes[scene] = stack_masked_tif_path
+
+    return masked_scenes
+
+
+def upload(paths, bucket):
+
+    for path in paths:
+        save_task_file_to_s3(path, 'benchmark', bucket=bucket)
+
+
+def run_pipeline(args, root_dir):
+
+    fixtures_dir = f'{root_dir}/fixtures'
+    task_dir = f'{root_dir}/task'
+    os.makedirs(task_dir)
+
+    cloud_model_path = create_model(f'{root_dir}/cloud_model.pth', bias=-20.0)
+    landcover_model_path = create_model(f'{root_dir}/landcover_model.pth', classes=8, encoder='resnet34')
+
+    start_date = dt(2023, 1, 1)
+    items = [
+        create_scene_fixture(fixtures_dir, f'S2B_35MRU_{(start_date + td(days=5 * i)).strftime("%Y%m%d")}_0_L2A', size=args.size,
+                             cloud_fraction=0.05 + 0.1 * (i % 4), date=start_date + td(days=5 * i), seed=i)
+        for i in range(args.scenes)
+    ]
+
+    # a bbox over the middle of the scenes so every read is a real window
+    xmin, ymin, xmax, ymax = shape(items[0].geometry).bounds
+    dx, dy = (xmax - xmin) / 8, (ymax - ymin) / 8
+    bbox = box(xmin + dx, ymin + dy, xmax - dx, ymax - dy).bounds
+
+    res = 10 / (111.32 * 1000)
+    results = {}
+
+    with serve_directory(fixtures_dir, latency=args.latency) as base_url:
+        stac.set_catalog_client(RecordedCatalogClient(get_served_items(items, base_url)))
+        stac.STAC_CACHE_DIR = f'{root_dir}/stac_cache'
+
+        collection = run_stage(results, 'get_cloud_freeish_collection', get_cloud_freeish_collection,
+                               start_date, start_date + td(days=5 * args.scenes), bbox, f'{task_dir}/s2_collection.json')
+        scenes = run_stage(results, 'download_collection', download_collection, collection, bbox, S2_BANDS_TIFF_ORDER, task_dir, res)
+
+    masked_scenes = run_stage(results, 'apply_cloud_mask', mask_scenes, scenes, task_dir, cloud_model_path)
+
+    composite_path = f'{task_dir}/composite.tif'
+    run_stage(results, 'merge_scenes', merge_scenes, masked_scenes, composite_path)
+
+    rgb_path, rgba_path, rgb_plot = f'{task_dir}/rgb_byte.tif', f'{task_dir}/rgba_byte.tif', f'{task_dir}/rgb.png'
+    run_stage(results, 'create_rgb_byte_tifs_from_composite', create_rgb_byte_tifs_from_composite, composite_path, rgb_path, rgba_path, rgb_plot, is_cog=True)
+
+    if args.s3_bucket is not None:
+        run_stage(results, 'create_task_tiles_on_s3', create_task_tiles_on_s3, rgba_path, 'rgb_byte_tiles', 'benchmark', bucket=args.s3_bucket, max_zoom=args.max_zoom)
+    else:
+        run_stage(results, 'create_map_tiles', create_map_tiles, rgba_path, f'{task_dir}/rgb_byte_tiles', max_zoom=args.max_zoom)
+
+    landcover_path = f'{task_dir}/landcover.tif'
+    run_stage(results, 'apply_landcover_classification', apply_landcover_classification, composite_path, landcover_path, landcover_model_path)
+
+    landcover_rgb_path, landcover_rgba_path, landcover_plot = f'{task_dir}/landcover_rgb_byte.tif', f'{task_dir}/landcover_rgba_byte.tif', f'{task_dir}/landcover.png'
+    run_stage(results, 'create_rgb_byte_tifs_from_landcover', create_rgb_byte_tifs_from_landcover, landcover_path, landcover_rgb_path, landcover_rgba_path, landcover_plot, is_cog=True)
+
+    if args.s3_bucket is not None:
+        run_stage(results, 's3_upload', upload, [rgb_plot, rgb_path, composite_path, landcover_plot, landcover_rgb_path], args.s3_bucket)
+
+    return results
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+
+    regressions = []
+
+    print(f'{"stage":<36} {"seconds":>8} {"baseline":>9} {"peak MB":>8} {"baseline":>9}')
+    for stage in STAGES:
+        if stage not in results:
+            print(f'{stage:<36} {"skipped":>8}')
+            continue
+
+        seconds, peak_rss_mb = results[stage]['seconds'], results[stage]['peak_rss_mb']
+        base = baseline.get(stage)
+        if base is None:
+            print(f'{stage:<36} {seconds:>8.2f} {"-":>9} {peak_rss_mb:>8.0f} {"-":>9}')
+            continue
+
+        flags = []
+        if seconds > base['seconds'] * (1 + time_tolerance):
+            flags.append('SLOWER')
+        if peak_rss_mb > base['peak_rss_mb'] * (1 + memory_tolerance):
+            flags.append('BIGGER')
+        if flags:
+            regressions.append(stage)
+
+        print(f'{stage:<36} {seconds:>8.2f} {base["seconds"]:>9.2f} {peak_rss_mb:>8.0f} {base["peak_rss_mb"]:>9.0f} {" ".join(flags)}')
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenes', type=int, default=4)
+    parser.add_argument('--size', type=int, default=1024, help='scene width and height in 10 m pixels')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every HTTP request')
+    parser.add_argument('--max-zoom', type=int, default=14)
+    parser.add_argument('--s3-bucket', default=None, help='bucket to time the upload stage against')
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--update-baselines', action='store_true', help='store this run as the baseline for its scene count and size')
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='allowed fractional slowdown per stage')
+    parser.add_argument('--memory-tolerance', type=float, default=0.15, help='allowed fractional peak RSS growth per stage')
+    args = parser.parse_args()
+
+    # don't let GDAL list the fixture directory on every open
+    os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        results = run_pipeline(args, root_dir)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    config = f'{args.scenes}x{args.size}'
+    print()
+    print(f'{args.scenes} scenes of {args.size} x {args.size} px, baseline {config}')
+    regressions = compare(results, baselines.get(config, {}), args.time_tolerance, args.memory_tolerance)
+
+    if args.update_baselines:
+        baselines[config] = results
+        os.makedirs(os.path.dirname(args.baselines), exist_ok=True)
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'baselines for {config} saved to {args.baselines}')
+
+    elif config not in baselines:
+        # nothing to compare with isn't a pass, record one on the reference machine first
+        print(f'NO BASELINE for {config} in {args.baselines}, run with --update-baselines on the reference machine')
+        sys.exit(1)
+
+    elif regressions:
+        print(f'regressions in {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Compares imagery.create_rgb_byte_tifs_from_composite, one pass writing the RGB and RGBA byte
+tifs and the preview PNG, with the old two create_rgb_byte_tif_from_composite calls through
+skimage.exposure.adjust_gamma followed by plot_tif. Reports wall time, peak RSS and how many
+bytes differ between the versions' tifs. The old version only runs where scikit-image is
+installed, it is no longer in requirements.txt.
+
+    python -m benchmarks.bench_render --size 8192 --block-rows 512 1024 4096
+"""
+
+import argparse
+import numpy as np
+import rasterio
+import tempfile
+import time
+
+from common.utilities.imagery import create_rgb_byte_tifs_from_composite, write_array_to_tif
+from common.utilities.profiling import track_peak_rss
+from common.utilities.visualization import plot_tif
+
+
+def create_composite(dst_path, size, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    # reflectance with a nodata corner, like a clipped composite
+    data = rng.random((size, size, 4), dtype=np.float32) * 0.6
+    data[:size // 4, :size // 4] = -9999
+    write_array_to_tif(data, dst_path, [30.0, -1.0 - size * 9e-5, 30.0 + size * 9e-5, -1.0])
+
+
+def create_rgb_byte_tif_legacy(composite_path, dst_path, use_alpha=False):
+
+    from skimage import exposure
+
+    with rasterio.open(composite_path) as src:
+        bbox = list(src.bounds)
+        rgb_stack = src.read((3, 2, 1), masked=True)
+        rgb_mask = rgb_stack.mask[0, :, :]
+
+    gamma_stack = np.zeros_like(rgb_stack)
+    for i in range(3):
+        gamma_stack[i, :, :] = exposure.adjust_gamma(rgb_stack[i, :, :], 0.6)
+
+    rgb_stack = np.clip(gamma_stack * 254, 0, 254).astype(np.uint8)
+
+    if use_alpha:
+        alpha = np.where(~rgb_mask, 255, 0)
+        rgb_stack = np.stack((rgb_stack[0, :, :], rgb_stack[1, :, :], rgb_stack[2, :, :], alpha), axis=0)
+
+    write_array_to_tif(rgb_stack.transpose((1, 2, 0)), dst_path, bbox, dtype=np.uint8, nodata=255)
+
+
+def render_legacy(composite_path, root_dir):
+
+    create_rgb_byte_tif_legacy(composite_path, f'{root_dir}/rgb_legacy.tif')
+    create_rgb_byte_tif_legacy(composite_path, f'{root_dir}/rgba_legacy.tif', use_alpha=True)
+    plot_tif(f'{root_dir}/rgb_legacy.tif', f'{root_dir}/rgb_legacy.png', bands=[1, 2, 3], cmap=None)
+
+
+def count_differences(path, reference_path):
+
+    with rasterio.open(path) as src, rasterio.open(reference_path) as reference:
+        return int((src.read() != reference.read()).sum())
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=8192, help='composite width and height in 10 m pixels')
+    parser.add_argument('--block-rows', type=int, nargs='+', default=[512, 1024, 4096])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        composite_path = f'{root_dir}/composite.tif'
+        create_composite(composite_path, args.size)
+
+        print(f'{args.size} x {args.size} px composite')
+        print(f'{"version":<16} {"seconds":>8} {"peak MB":>8}  differing bytes')
+
+        legacy = True
+        try:
+            with track_peak_rss() as rss:
+                start_time = time.time()
+                render_legacy(composite_path, root_dir)
+                elapsed = time.time() - start_time
+            print(f'{"legacy":<16} {elapsed:>8.2f} {rss["peak_rss_bytes"] / 1e6:>8.0f}')
+        except ImportError:
+            legacy = False
+            print(f'{"legacy":<16} {"skipped, scikit-image is not installed":>8}')
+
+        for block_rows in args.block_rows:
+            rgb_path, rgba_path = f'{root_dir}/rgb_{block_rows}.tif', f'{root_dir}/rgba_{block_rows}.tif'
+            with track_peak_rss() as rss:
+                start_time = time.time()
+                create_rgb_byte_tifs_from_composite(composite_path, rgb_path, rgba_path, f'{root_dir}/rgb_{block_rows}.png', block_rows=block_rows)
+                elapsed = time.time() - start_time
+
+            differences = ''
+            if legacy:
+                differences = f'{count_differences(rgb_path, f"{root_dir}/rgb_legacy.tif")} rgb, {count_differences(rgba_path, f"{root_dir}/rgba_legacy.tif")} rgba'
+            print(f'{f"{block_rows} rows":<16} {elapsed:>8.2f} {rss["peak_rss_bytes"] / 1e6:>8.0f}  {differences}')
+
+
+if __name__ == '__main__':
+    main()
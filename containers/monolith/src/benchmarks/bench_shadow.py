@@ -0,0 +1,102 @@
+"""
+Compares the fused cloud shadow projection with the old np.roll and stack version on a synthetic
+cloud mask. Checks the masks are identical and reports wall time and peak traced allocation,
+for the production height sweep and finer ones.
+
+    python -m benchmarks.bench_shadow --size 4096 --height-steps 200 50 10
+"""
+
+import argparse
+import numpy as np
+from scipy.ndimage import binary_dilation
+import time
+import tracemalloc
+
+from common.utilities import masking
+
+
+AZIMUTH, ZENITH = 130.0, 35.0
+
+
+def get_potential_shadow_legacy(cloud_height, azimuth_rad, zenith_rad, cloud_mask, scale=10):
+
+    shadow_vector = round(np.tan(zenith_rad) * cloud_height)
+    x_shift = round(np.cos(azimuth_rad) * shadow_vector / scale)
+    y_shift = round(np.sin(azimuth_rad) * shadow_vector / scale)
+
+    shadows = np.roll(cloud_mask, y_shift, axis=0)
+    shadows = np.roll(shadows, x_shift, axis=1)
+
+    if x_shift > 0:
+        shadows[:, :x_shift] = False
+    elif x_shift < 0:
+        shadows[:, x_shift:] = False
+
+    if y_shift > 0:
+        shadows[:y_shift, :] = False
+    elif y_shift < 0:
+        shadows[y_shift:, :] = False
+
+    return shadows
+
+
+def get_cloud_shadow_mask_legacy(cloud_mask, azimuth, zenith, cloud_heights):
+
+    azimuth_rad = np.deg2rad(azimuth - 270)
+    zenith_rad = np.deg2rad(zenith)
+
+    potential_shadow = np.array([
+        get_potential_shadow_legacy(cloud_height, azimuth_rad, zenith_rad, cloud_mask)
+        for cloud_height in cloud_heights
+    ])
+
+    return np.sum(potential_shadow, axis=0) > 0
+
+
+def get_cloud_shadow_mask_fused(cloud_mask, azimuth, zenith, cloud_heights):
+    return masking.__get_cloud_shadow_mask(cloud_mask, azimuth, zenith, cloud_heights)
+
+
+def measure(func, cloud_mask, cloud_heights, repeats):
+
+    timings = []
+    for _ in range(repeats):
+        start_time = time.time()
+        func(cloud_mask, AZIMUTH, ZENITH, cloud_heights)
+        timings.append(time.time() - start_time)
+
+    tracemalloc.start()
+    shadow = func(cloud_mask, AZIMUTH, ZENITH, cloud_heights)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return shadow, min(timings), peak
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=4096, help='mask width and height in pixels')
+    parser.add_argument('--height-steps', type=int, nargs='+', default=[200, 50, 10], help='cloud height sweep steps in meters, 200 is production')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    # clumpy clouds, like a partly cloudy scene
+    rng = np.random.default_rng(0)
+    cloud_mask = binary_dilation(rng.random((args.size, args.size)) < 0.002, iterations=4)
+
+    print(f'{args.size} x {args.size} px, {cloud_mask.mean():.1%} cloud')
+    print(f'{"step m":>7} {"heights":>8} {"version":<7} {"seconds":>8} {"peak MB":>8} {"identical":>10}')
+    for step in args.height_steps:
+        cloud_heights = np.arange(400, 1600, step)
+
+        legacy, legacy_secs, legacy_peak = measure(get_cloud_shadow_mask_legacy, cloud_mask, cloud_heights, args.repeats)
+        fused, fused_secs, fused_peak = measure(get_cloud_shadow_mask_fused, cloud_mask, cloud_heights, args.repeats)
+        identical = np.array_equal(legacy, fused)
+
+        print(f'{step:>7} {len(cloud_heights):>8} {"legacy":<7} {legacy_secs:>8.3f} {legacy_peak / 1e6:>8.1f}')
+        print(f'{step:>7} {len(cloud_heights):>8} {"fused":<7} {fused_secs:>8.3f} {fused_peak / 1e6:>8.1f} {str(identical):>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Runs repeated searches through the STAC search cache against a recorded catalog, offline.
+Pass --recording to replay items saved with benchmarks.fixtures.record_search, otherwise
+synthetic items over a grid of squares are used.
+
+    python -m benchmarks.bench_stac_cache --repeats 5 --page-latency 0.5
+"""
+
+import argparse
+from datetime import datetime as dt
+from datetime import timedelta as td
+import tempfile
+import time
+
+from benchmarks.fixtures import RecordedCatalogClient, get_scene_item
+from common.utilities import stac
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recording', default=None, help='ItemCollection JSON saved by record_search')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--page-latency', type=float, default=0.5, help='seconds per page of 100 items')
+    args = parser.parse_args()
+
+    if args.recording is not None:
+        client = RecordedCatalogClient.from_file(args.recording, page_latency=args.page_latency)
+    else:
+        items = []
+        for day in range(0, 80, 5):
+            for square, origin in [('MRU', (600000, 9900000)), ('MRV', (600000, 10000000))]:
+                scene_id = f'S2B_35{square}_{(dt(2023, 1, 1) + td(days=day)).strftime("%Y%m%d")}_0_L2A'
+                bbox_utm = [origin[0], origin[1] - 109800, origin[0] + 109800, origin[1]]
+                items.append(get_scene_item(scene_id, bbox_utm, 32735, cloud_fraction=(day % 7) / 7, grid_square=square, date=dt(2023, 1, 1) + td(days=day)))
+        client = RecordedCatalogClient(items, page_latency=args.page_latency)
+
+    stac.set_catalog_client(client)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        stac.STAC_CACHE_DIR = cache_dir
+
+        bbox = client.items[0].bbox
+        params = {
+            'bbox': bbox,
+            'collections': ['sentinel-s2-l2a-cogs'],
+            'datetime': '2023-01-01T00:00:00Z/2023-03-22T00:00:00Z',
+            'sortby': 'properties.eo:cloud_cover',
+            'query': {"eo:cloud_cover": {"lt": str(98)}},
+        }
+
+        for i in range(args.repeats):
+            start_time = time.time()
+            items = stac.search_items(**params)
+            print(f'search {i + 1}: {len(items)} items in {time.time() - start_time:.3f}s')
+
+        # a bbox that only differs past the key's rounding shares the entry
+        stac.search_items(**{**params, 'bbox': [c + 1e-7 for c in bbox]})
+
+        print()
+        print('catalog searches:', client.search_count)
+        print('cache stats:', stac.cache_stats)
+
+
+if __name__ == '__main__':
+    main()
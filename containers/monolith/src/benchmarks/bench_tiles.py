@@ -0,0 +1,158 @@
+"""
+Compares tiles.create_map_tiles with the old full gdal.Warp to EPSG:3857 followed by
+gdal2tiles.generate_tiles, on a synthetic RGBA byte COG like the handler's rgba_byte.tif.
+Reports wall time, files written, tiles per zoom and how far the deepest zoom's tiles are
+apart. The old version only runs where gdal2tiles is installed, it is no longer in
+requirements.txt. The PMTiles archive of the same pyramid is timed last.
+
+    python -m benchmarks.bench_tiles --size 4096 --max-zoom 14 --workers 1 4
+"""
+
+import argparse
+import glob
+import json
+import numpy as np
+import os
+import rasterio
+import tempfile
+import time
+
+from common.utilities.imagery import write_array_to_tif
+from common.utilities.tiles import TILES_MANIFEST_NAME, create_map_tiles, create_map_tiles_archive
+
+
+def create_rgba(dst_path, size, seed=0):
+
+    rng = np.random.default_rng(seed)
+    res = 10 / (111.32 * 1000)
+
+    # smooth colour with an irregular transparent edge, like a clipped composite
+    rows, cols = np.mgrid[0:size, 0:size] / size
+    rgb = np.stack([rows, cols, (rows + cols) / 2], axis=2) * 254
+    rgb += rng.normal(0, 8, rgb.shape)
+    alpha = np.where((rows - 0.5) ** 2 + (cols - 0.5) ** 2 < 0.2 + rng.normal(0, 0.002, rows.shape), 255, 0)
+
+    data = np.concatenate([np.clip(rgb, 0, 254), alpha[:, :, None]], axis=2).astype(np.uint8)
+    write_array_to_tif(data, dst_path, [30.0, -1.0 - size * res, 30.0 + size * res, -1.0], dtype=np.uint8, is_cog=True, nodata=255)
+
+
+def create_map_tiles_legacy(file_path, tiles_dir, min_zoom=2, max_zoom=14):
+
+    import gdal2tiles
+    from osgeo import gdal
+
+    wb_file_path = file_path.replace('.tif', '_wm.tif')
+    gdal.Warp(wb_file_path, file_path, dstSRS="EPSG:3857")
+
+    options = {
+        'kml': True,
+        'nb_processes': 8,
+        'profile': 'mercator',
+        's_srs': 'EPSG:3857',
+        'tile_size': 256,
+        'title': 'Smart Carte',
+        'zoom': (min_zoom, max_zoom),
+    }
+
+    gdal2tiles.generate_tiles(wb_file_path, tiles_dir, **options)
+
+
+def get_aliases(tiles_dir):
+
+    manifest_path = f'{tiles_dir}/{TILES_MANIFEST_NAME}'
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)['aliases']
+
+
+def count_tiles(tiles_dir):
+
+    # tiles with content per zoom, shared ones counted at every path they stand for
+    tile_paths = [os.path.relpath(path, tiles_dir) for path in glob.glob(f'{tiles_dir}/*/*/*.png')]
+
+    counts = {}
+    for tile_path in tile_paths + list(get_aliases(tiles_dir)):
+        zoom = int(tile_path.split('/')[0])
+        counts[zoom] = counts.get(zoom, 0) + 1
+    return counts
+
+
+def count_files(tiles_dir):
+    return len(glob.glob(f'{tiles_dir}/**/*.png', recursive=True))
+
+
+def get_tile_difference(tiles_dir, reference_dir, zoom):
+
+    # mean absolute difference over tiles both versions wrote, where both are opaque
+    aliases = get_aliases(tiles_dir)
+    tile_paths = [os.path.relpath(path, tiles_dir) for path in glob.glob(f'{tiles_dir}/{zoom}/*/*.png')]
+    tile_paths += [tile_path for tile_path in aliases if tile_path.startswith(f'{zoom}/')]
+
+    differences = []
+    for tile_path in tile_paths:
+        reference_path = f'{reference_dir}/{tile_path}'
+        if not os.path.exists(reference_path):
+            continue
+
+        with rasterio.open(f'{tiles_dir}/{aliases.get(tile_path, tile_path)}') as src:
+            tile = src.read().astype(np.float32)
+        with rasterio.open(reference_path) as src:
+            reference = src.read().astype(np.float32)
+
+        opaque = (tile[3] > 0) & (reference[3] > 0)
+        if opaque.any():
+            differences.append(np.abs(tile[:3] - reference[:3])[:, opaque].mean())
+
+    return np.mean(differences) if differences else float('nan')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=4096, help='source width and height in 10 m pixels')
+    parser.add_argument('--max-zoom', type=int, default=14)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        rgba_path = f'{root_dir}/rgba_byte.tif'
+        create_rgba(rgba_path, args.size)
+
+        print(f'{args.size} x {args.size} px source')
+        print(f'{"version":<12} {"seconds":>8} {"files":>7}  tiles per zoom')
+
+        reference_dir = None
+        try:
+            reference_dir = f'{root_dir}/tiles_legacy'
+            start_time = time.time()
+            create_map_tiles_legacy(rgba_path, reference_dir, max_zoom=args.max_zoom)
+            counts = count_tiles(reference_dir)
+            print(f'{"legacy":<12} {time.time() - start_time:>8.2f} {count_files(reference_dir):>7}  {dict(sorted(counts.items()))}')
+        except ImportError:
+            reference_dir = None
+            print(f'{"legacy":<12} {"skipped, gdal2tiles is not installed":>8}')
+
+        for workers in args.workers:
+            tiles_dir = f'{root_dir}/tiles_{workers}'
+            start_time = time.time()
+            _, max_zoom = create_map_tiles(rgba_path, tiles_dir, max_zoom=args.max_zoom, max_workers=workers)
+            elapsed = time.time() - start_time
+
+            counts = count_tiles(tiles_dir)
+            print(f'{f"{workers} workers":<12} {elapsed:>8.2f} {count_files(tiles_dir):>7}  {dict(sorted(counts.items()))}')
+
+            if reference_dir is not None:
+                print(f'{"":<12} zoom {max_zoom} mean abs difference from legacy {get_tile_difference(tiles_dir, reference_dir, max_zoom):.2f}')
+
+        try:
+            archive_path = f'{root_dir}/tiles.pmtiles'
+            start_time = time.time()
+            create_map_tiles_archive(rgba_path, archive_path, max_zoom=args.max_zoom, max_workers=max(args.workers))
+            print(f'{"pmtiles":<12} {time.time() - start_time:>8.2f} {1:>7}  {os.path.getsize(archive_path) / 1e6:.1f} MB archive')
+        except ImportError:
+            print(f'{"pmtiles":<12} {"skipped, pmtiles is not installed":>8}')
+
+
+if __name__ == '__main__':
+    main()
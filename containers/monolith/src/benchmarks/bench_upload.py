@@ -0,0 +1,108 @@
+"""
+Compares s3.put_items with the old serial upload, a new boto3 resource and upload_file call per
+file, on a directory of tile sized files. Runs against an in-process moto S3 server, or any S3
+compatible endpoint such as MinIO with --endpoint-url. --latency adds a delay to every request,
+like the round trip to a real bucket.
+
+    python -m benchmarks.bench_upload --files 2000 --latency 0.03 --workers 1 8 32
+    python -m benchmarks.bench_upload --endpoint-url http://localhost:9000 --bucket tiles-bench
+"""
+
+import argparse
+import boto3
+import numpy as np
+import os
+import tempfile
+import time
+
+from common.aws import s3 as s3_utils
+
+
+def create_files(root_dir, count, size, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    items = []
+    for i in range(count):
+        file_path = f'{root_dir}/{i // 100}/{i % 100}.png'
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(rng.bytes(size))
+        items.append((file_path, f'bench/{i // 100}/{i % 100}.png'))
+
+    return items
+
+
+def put_items_legacy(items, bucket, endpoint_url):
+
+    for file_path, object_key in items:
+        s3 = boto3.resource('s3', endpoint_url=endpoint_url)
+        s3.meta.client.upload_file(file_path, bucket, object_key)
+
+
+def start_moto_server(port):
+
+    from moto.server import ThreadedMotoServer
+
+    # moto accepts any credentials, just not none
+    for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        os.environ.setdefault(key, 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, f'http://127.0.0.1:{port}'
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--file-size', type=int, default=20000, help='bytes, about a 256 px PNG tile')
+    parser.add_argument('--latency', type=float, default=0.03, help='seconds added to every request')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--endpoint-url', default=None, help='S3 compatible endpoint, a moto server is started without one')
+    parser.add_argument('--bucket', default='upload-bench')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = start_moto_server(args.port)
+
+    # every client made from the default session, the legacy resources included, waits first
+    if args.latency > 0:
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register('before-send.s3', lambda **kwargs: time.sleep(args.latency))
+
+    s3_utils.S3_ENDPOINT_URL = endpoint_url
+    s3_utils.get_s3_client.cache_clear()
+
+    try:
+        client = s3_utils.get_s3_client()
+        if args.bucket not in [bucket['Name'] for bucket in client.list_buckets()['Buckets']]:
+            client.create_bucket(Bucket=args.bucket)
+
+        with tempfile.TemporaryDirectory() as root_dir:
+            items = create_files(root_dir, args.files, args.file_size)
+
+            print(f'{args.files} files of {args.file_size / 1000:.0f} kB, {args.latency * 1000:.0f} ms per request')
+            print(f'{"version":<12} {"seconds":>8} {"files/s":>8} {"MB/s":>6}')
+
+            start_time = time.time()
+            put_items_legacy(items, args.bucket, endpoint_url)
+            legacy_secs = time.time() - start_time
+            print(f'{"legacy":<12} {legacy_secs:>8.2f} {args.files / legacy_secs:>8.0f} {args.files * args.file_size / 1e6 / legacy_secs:>6.1f}')
+
+            for workers in args.workers:
+                stats = s3_utils.put_items(items, args.bucket, max_workers=workers)
+                print(f'{f"{workers} workers":<12} {stats["secs"]:>8.2f} {stats["files"] / stats["secs"]:>8.0f} {stats["bytes"] / 1e6 / stats["secs"]:>6.1f}')
+
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
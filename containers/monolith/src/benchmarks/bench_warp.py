@@ -0,0 +1,122 @@
+"""
+Compares the in-memory warp and stack stage of download_collection with the old per-band
+GeoTIFF write, in-place gdal.Warp and re-read cycle. Checks the stacks are pixel-identical
+and reports wall time and bytes written to disk.
+
+    python -m benchmarks.bench_warp --size 2048 --repeats 3
+"""
+
+import argparse
+import numpy as np
+import os
+from osgeo import gdal
+import rasterio
+from shapely.geometry import box
+import tempfile
+import time
+
+from common.constants import NODATA_FLOAT32, S2_BANDS_TIFF_ORDER
+from common.utilities.imagery import normalize_original_s2_array, warp_array, write_array_to_tif
+from common.utilities.projections import reproject_shape
+
+
+def get_written_bytes():
+
+    # wchar counts every write() call, page cache or not
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+
+
+def get_band_windows(size, epsg, bbox_utm, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    band_windows = []
+    for band in S2_BANDS_TIFF_ORDER:
+        res = 20 if band == 'SCL' else 10
+        shape = (size * 10 // res, size * 10 // res)
+        data = rng.integers(1, 4095, size=shape).astype(np.uint16)
+        data = np.ma.array(data, mask=np.zeros(shape, dtype=bool))
+        data.mask[:, :shape[1] // 8] = True # a nodata edge, like a scene boundary
+        transform = rasterio.transform.from_origin(bbox_utm[0], bbox_utm[3], res, res)
+        band_windows.append((band, data, transform))
+
+    return band_windows
+
+
+def write_stack_legacy(band_windows, scene_dir, epsg, bbox_utm, bbox_ll, res):
+
+    band_tif_paths = []
+    for band, s3_data, s3_transform in band_windows:
+        band_path = f'{scene_dir}/{band}.tif'
+        s3_data = normalize_original_s2_array(s3_data)
+        write_array_to_tif(s3_data, band_path, bbox_utm, dtype=np.float32, epsg=epsg, nodata=NODATA_FLOAT32, transform=s3_transform)
+        gdal.Warp(band_path, band_path, dstSRS="EPSG:4326", xRes=res, yRes=res, outputBounds=bbox_ll)
+        band_tif_paths.append(band_path)
+
+    stack_data = []
+    for path in band_tif_paths:
+        with rasterio.open(path) as src:
+            stack_data.append(src.read(1))
+
+    stack_path = f'{scene_dir}/stack_original.tif'
+    stack_data = np.array(stack_data).transpose((1, 2, 0))
+    write_array_to_tif(stack_data, stack_path, bbox_ll, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32)
+    return stack_path
+
+
+def write_stack_in_memory(band_windows, scene_dir, epsg, bbox_utm, bbox_ll, res):
+
+    stack_data = []
+    for band, s3_data, s3_transform in band_windows:
+        s3_data = normalize_original_s2_array(s3_data)
+        stack_data.append(warp_array(s3_data, s3_transform, epsg, bbox_ll, res))
+
+    stack_path = f'{scene_dir}/stack_original.tif'
+    stack_data = np.array(stack_data).transpose((1, 2, 0))
+    write_array_to_tif(stack_data, stack_path, bbox_ll, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32)
+    return stack_path
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2048, help='window width and height in 10 m pixels')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    epsg = 32735
+    bbox_utm = [600000, 9900000 - args.size * 10, 600000 + args.size * 10, 9900000]
+    bbox_ll = list(reproject_shape(box(*bbox_utm), init_proj=f'EPSG:{epsg}', target_proj="EPSG:4326").bounds)
+    res = 10 / (111.32 * 1000)
+
+    band_windows = get_band_windows(args.size, epsg, bbox_utm)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+
+        results = {}
+        for name, func in [('legacy', write_stack_legacy), ('in-memory', write_stack_in_memory)]:
+            timings, written = [], []
+            for i in range(args.repeats):
+                scene_dir = f'{root_dir}/{name}_{i}'
+                os.makedirs(scene_dir)
+
+                written_start, start_time = get_written_bytes(), time.time()
+                stack_path = func(band_windows, scene_dir, epsg, bbox_utm, bbox_ll, res)
+                timings.append(time.time() - start_time)
+                written.append(get_written_bytes() - written_start)
+
+            with rasterio.open(stack_path) as src:
+                results[name] = (min(timings), np.mean(written), src.read())
+
+        identical = np.array_equal(results['legacy'][2], results['in-memory'][2])
+
+        print(f'{args.size} x {args.size} px window, {len(band_windows)} bands, pixel-identical: {identical}')
+        for name, (elapsed, written, _) in results.items():
+            print(f'{name:<10} wall={elapsed:6.2f}s  written={written / 1e6:8.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
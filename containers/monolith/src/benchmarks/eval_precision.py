@@ -0,0 +1,111 @@
+"""
+Evaluates every model precision against fp32 on fixture chips and reports agreement, IoU and
+latency, then names the fastest precision within the tolerance. Set MODEL_PRECISION to opt in.
+Chips are cut at random from the given stacks or composites, or are synthetic when none are given,
+which is only good for latency. Half the chips calibrate int8_static, whose weights are saved next
+to the model and need to ship with it.
+
+    python -m benchmarks.eval_precision --model common/models/cloud_detection_model_resnet18_dice_20230327.pth --tifs /tmp/task/*/stack_original.tif
+    python -m benchmarks.eval_precision --model common/models/landcover_classification_model_resnet34_dice_20230406.pth --tifs /tmp/task/composite.tif
+"""
+
+import argparse
+import numpy as np
+import rasterio
+import time
+
+from common.utilities.models import MODEL_PRECISIONS, calibrate_static_int8, predict, sigmoid
+
+
+def get_chips(tif_paths, channels, chip_size, count, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    if not tif_paths:
+        return rng.random((count, channels, chip_size, chip_size), dtype=np.float32)
+
+    chips = []
+    for i in range(count):
+        with rasterio.open(tif_paths[i % len(tif_paths)]) as src:
+            row = rng.integers(0, max(src.height - chip_size, 0) + 1)
+            col = rng.integers(0, max(src.width - chip_size, 0) + 1)
+            window = rasterio.windows.Window(col, row, chip_size, chip_size)
+            chip = src.read(list(range(1, channels + 1)), masked=True, window=window, boundless=True)
+            chips.append(chip.filled(-1.0)) # same fill as the pipeline
+
+    return np.array(chips, dtype=np.float32)
+
+
+def get_class_map(logits):
+
+    # one channel is a binary mask, more are classes
+    if logits.shape[1] == 1:
+        return (sigmoid(logits[:, 0]) >= 0.50).astype(np.uint8)
+    return np.argmax(logits, axis=1).astype(np.uint8)
+
+
+def get_mean_iou(reference, other):
+
+    ious = []
+    for value in np.union1d(np.unique(reference), np.unique(other)):
+        intersection = np.sum((reference == value) & (other == value))
+        union = np.sum((reference == value) | (other == value))
+        ious.append(intersection / union)
+
+    return np.mean(ious)
+
+
+def run(model_path, chips, precision):
+
+    predict(model_path, chips[:1], precision=precision) # load and warm up
+
+    logits, timings = [], []
+    for chip in chips:
+        start_time = time.time()
+        logits.append(predict(model_path, chip[None], precision=precision))
+        timings.append(time.time() - start_time)
+
+    return np.concatenate(logits), np.median(timings)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, help='path to the fp32 .pth model')
+    parser.add_argument('--tifs', nargs='*', default=[], help='stacks or composites to cut chips from')
+    parser.add_argument('--channels', type=int, default=4, help='bands the model takes, the first ones of each tif')
+    parser.add_argument('--chip-size', type=int, default=256)
+    parser.add_argument('--chips', type=int, default=32)
+    parser.add_argument('--tolerance', type=float, default=0.99, help='minimum pixel agreement with fp32')
+    parser.add_argument('--precisions', nargs='+', default=list(MODEL_PRECISIONS), choices=MODEL_PRECISIONS)
+    args = parser.parse_args()
+
+    chips = get_chips(args.tifs, args.channels, args.chip_size, args.chips)
+    calibration_chips, eval_chips = chips[:len(chips) // 2], chips[len(chips) // 2:]
+
+    if 'int8_static' in args.precisions:
+        print(f'calibrated int8_static on {len(calibration_chips)} chips, saved to {calibrate_static_int8(args.model, calibration_chips)}')
+
+    reference, reference_latency = run(args.model, eval_chips, 'fp32')
+    reference = get_class_map(reference)
+
+    print(f'{len(eval_chips)} chips of {args.chip_size} px')
+    print(f'{"precision":<14} {"agreement":>10} {"mean IoU":>9} {"ms/chip":>8} {"speedup":>8}')
+
+    accepted = []
+    for precision in args.precisions:
+        logits, latency = run(args.model, eval_chips, precision)
+        class_map = get_class_map(logits)
+
+        agreement = np.mean(class_map == reference)
+        mean_iou = get_mean_iou(reference, class_map)
+        print(f'{precision:<14} {agreement:>10.4f} {mean_iou:>9.4f} {latency * 1000:>8.1f} {reference_latency / latency:>7.2f}x')
+
+        if agreement >= args.tolerance:
+            accepted.append((latency, precision))
+
+    print(f'fastest precision within {args.tolerance} agreement: {min(accepted)[1]}')
+
+
+if __name__ == '__main__':
+    main()
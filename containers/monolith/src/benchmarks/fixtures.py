@@ -0,0 +1,267 @@
+from contextlib import contextmanager
+from datetime import datetime as dt
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import os
+from pystac import Asset, Item, ItemCollection
+import re
+from shapely.geometry import box, mapping, shape
+import threading
+import time
+
+from common.constants import S2_BANDS_TIFF_ORDER
+from common.utilities.imagery import write_array_to_tif
+from common.utilities.projections import reproject_shape
+
+
+METADATA_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<Level-2A_Tile_ID>
+  <Geometric_Info>
+    <Tile_Angles>
+      <Mean_Sun_Angle>
+        <ZENITH_ANGLE unit="deg">{zenith}</ZENITH_ANGLE>
+        <AZIMUTH_ANGLE unit="deg">{azimuth}</AZIMUTH_ANGLE>
+      </Mean_Sun_Angle>
+    </Tile_Angles>
+  </Geometric_Info>
+</Level-2A_Tile_ID>
+"""
+
+
+### synthetic Sentinel-2 scenes ###
+
+def __get_blocky_field(rng, shape, block_size, low, high):
+
+    rows = shape[0] // block_size + 1
+    cols = shape[1] // block_size + 1
+    field = rng.uniform(low, high, size=(rows, cols))
+    field = np.repeat(np.repeat(field, block_size, axis=0), block_size, axis=1)
+    return field[:shape[0], :shape[1]]
+
+
+def create_scene_fixture(root_dir, scene_id, size=1024, epsg=32735, origin=(600000, 9900000),
+                         cloud_fraction=0.1, grid_square='MRU', date=None, seed=0):
+    """
+    Writes band, SCL and metadata fixtures for one scene and returns a STAC item with hrefs relative
+    to root_dir. Bands are 10 m COGs of size x size pixels, SCL is a 20 m COG, like the real archive.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    scene_dir = f'{root_dir}/{scene_id}'
+    os.makedirs(scene_dir, exist_ok=True)
+
+    xmin, ymax = origin
+    bbox_utm = [xmin, ymax - size * 10, xmin + size * 10, ymax]
+
+    for band in S2_BANDS_TIFF_ORDER:
+        band_path = f'{scene_dir}/{band}.tif'
+        if band == 'SCL':
+            clouds = __get_blocky_field(rng, (size // 2, size // 2), 16, 0, 1) < cloud_fraction
+            data = np.where(clouds, 9, 4).astype(np.uint8)
+            write_array_to_tif(data, band_path, bbox_utm, dtype=np.uint8, epsg=epsg, nodata=0, is_cog=True)
+        else:
+            data = __get_blocky_field(rng, (size, size), 8, 200, 3000) + rng.normal(0, 50, size=(size, size))
+            data = np.clip(data, 1, 4095).astype(np.uint16)
+            write_array_to_tif(data, band_path, bbox_utm, dtype=np.uint16, epsg=epsg, nodata=0, is_cog=True)
+
+    with open(f'{scene_dir}/metadata.xml', 'w') as f:
+        f.write(METADATA_XML.format(zenith=rng.uniform(20, 50), azimuth=rng.uniform(100, 160)))
+
+    return get_scene_item(scene_id, bbox_utm, epsg, cloud_fraction=cloud_fraction, grid_square=grid_square, date=date)
+
+
+def get_scene_item(scene_id, bbox_utm, epsg, cloud_fraction=0.1, grid_square='MRU', date=None):
+    """
+    STAC item for a fixture scene, with asset hrefs relative to the fixtures directory.
+    """
+
+    scene_poly_ll = reproject_shape(box(*bbox_utm), init_proj=f'EPSG:{epsg}', target_proj="EPSG:4326")
+
+    item = Item(
+        id=scene_id,
+        geometry=mapping(scene_poly_ll),
+        bbox=list(scene_poly_ll.bounds),
+        datetime=date if date is not None else dt(2023, 1, 1),
+        properties={
+            'eo:cloud_cover': round(cloud_fraction * 100, 2),
+            'proj:epsg': epsg,
+            'sentinel:grid_square': grid_square,
+        },
+    )
+
+    for band in S2_BANDS_TIFF_ORDER:
+        item.add_asset(band, Asset(href=f'{scene_id}/{band}.tif', media_type='image/tiff'))
+    item.add_asset('metadata', Asset(href=f'{scene_id}/metadata.xml', media_type='application/xml'))
+
+    return item
+
+
+def get_served_items(items, base_url):
+    """
+    Copies fixture items with their asset hrefs pointing at base_url.
+    """
+
+    served_items = []
+    for item in items:
+        served_item = item.clone()
+        for asset in served_item.assets.values():
+            asset.href = f'{base_url}/{asset.href}'
+        served_items.append(served_item)
+
+    return served_items
+
+
+### recorded STAC responses ###
+
+def record_search(dst_path, client, **params):
+    """
+    Saves the items of a live catalog search so RecordedCatalogClient can replay them offline.
+    """
+
+    collection = ItemCollection(items=list(client.search(**params).items()))
+    collection.save_object(dest_href=dst_path)
+    return dst_path
+
+
+class RecordedCatalogClient:
+    """
+    Offline stand-in for pystac_client.Client that answers searches from recorded items.
+    It applies the bbox, datetime, eo:cloud_cover and sortby parameters the pipeline uses,
+    and sleeps page_latency per page of page_size items to mimic catalog paging.
+    """
+
+    def __init__(self, items, page_size=100, page_latency=0.0):
+        self.items = list(items)
+        self.page_size = page_size
+        self.page_latency = page_latency
+        self.search_count = 0
+
+    @classmethod
+    def from_file(cls, recording_path, **kwargs):
+        return cls(ItemCollection.from_file(recording_path), **kwargs)
+
+    def search(self, bbox=None, collections=None, datetime=None, sortby=None, query=None, **kwargs):
+        self.search_count += 1
+        return RecordedSearch(self, bbox, datetime, sortby, query)
+
+
+class RecordedSearch:
+
+    def __init__(self, client, bbox, datetime, sortby, query):
+        self.client = client
+        self.bbox = bbox
+        self.datetime = datetime
+        self.sortby = sortby
+        self.query = query or {}
+
+    def items(self):
+
+        items = [item for item in self.client.items if self.__matches(item)]
+        if self.sortby is not None:
+            items.sort(key=lambda item: item.properties[self.sortby.lstrip('-+').replace('properties.', '')],
+                       reverse=self.sortby.startswith('-'))
+
+        for page_start in range(0, max(len(items), 1), self.client.page_size):
+            time.sleep(self.client.page_latency)
+            for item in items[page_start:page_start + self.client.page_size]:
+                yield item.clone()
+
+    def __matches(self, item):
+
+        if self.bbox is not None and not box(*self.bbox).intersects(shape(item.geometry)):
+            return False
+
+        if self.datetime is not None:
+            start, end = [dt.strptime(d, '%Y-%m-%dT%H:%M:%SZ') for d in self.datetime.split('/')]
+            if not start <= item.datetime.replace(tzinfo=None) <= end:
+                return False
+
+        for name, operators in self.query.items():
+            value = item.properties.get(name)
+            if 'lt' in operators and not value < float(operators['lt']):
+                return False
+
+        return True
+
+
+### throttled local HTTP server ###
+
+class ThrottledRangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler with HTTP range support, which GDAL needs for windowed COG reads,
+    plus a fixed per-request latency and an optional bandwidth cap in bytes per second.
+    """
+
+    latency = 0.0
+    bandwidth = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+
+        time.sleep(self.latency)
+
+        self.range_remaining = None
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().send_head()
+
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if start >= size:
+            f.close()
+            self.send_error(416, 'Requested range not satisfiable')
+            return None
+
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        f.seek(start)
+        self.range_remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+
+        remaining = self.range_remaining
+        while remaining is None or remaining > 0:
+            chunk_size = 64 * 1024 if remaining is None else min(64 * 1024, remaining)
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+
+            outputfile.write(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+
+
+@contextmanager
+def serve_directory(root_dir, latency=0.0, bandwidth=None):
+    """
+    Serves root_dir on a random localhost port and yields the base URL.
+    Use a fresh server per run so GDAL's /vsicurl/ cache can't carry reads over between runs.
+    """
+
+    handler_class = type('Handler', (ThrottledRangeRequestHandler,), {'latency': latency, 'bandwidth': bandwidth})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler_class, directory=root_dir))
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
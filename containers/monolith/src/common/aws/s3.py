@@ -1,6 +1,16 @@
 import boto3
+from botocore.config import Config
+from functools import lru_cache
+import os
+import queue
+import threading
+import time
 
 from common.aws import get_boto_client
+from common.constants import S3_MAX_ATTEMPTS, S3_UPLOAD_MAX_WORKERS, S3_UPLOAD_QUEUE_SIZE
+
+
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') # points uploads at a local MinIO or moto server
 
 
 def get_files(prefix, suffix, bucket_name):
@@ -38,8 +48,136 @@ def put_s3_item(body, bucket, object_key):
     client.put_object(Body=body, Bucket=bucket, Key=object_key)
 
 
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """
+    One S3 client for the process, they are thread safe. Its connection pool fits
+    S3_UPLOAD_MAX_WORKERS uploads and throttled or failed requests are retried with exponential
+    backoff, up to S3_MAX_ATTEMPTS attempts.
+    """
+
+    config = Config(
+        max_pool_connections=S3_UPLOAD_MAX_WORKERS,
+        retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'},
+    )
+
+    return boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, config=config)
+
+
 def put_item(file_path, bucket, object_key):
-    s3 = boto3.resource('s3')
-    s3.meta.client.upload_file(file_path, bucket, object_key)
+    get_s3_client().upload_file(file_path, bucket, object_key)
+
+
+def put_items(items, bucket, max_workers=S3_UPLOAD_MAX_WORKERS):
+    """
+    Uploads (file_path, object_key) pairs concurrently through an S3Uploader, returns its stats.
+    """
+
+    with S3Uploader(bucket, max_workers=max_workers) as uploader:
+        for file_path, object_key in items:
+            with open(file_path, 'rb') as f:
+                uploader.put(f.read(), object_key)
+
+    return uploader.stats
+
+
+class S3Uploader:
+    """
+    Uploads bodies put on a bounded queue from max_workers threads sharing the pooled client, so
+    files are uploaded while the producer is still making them. put blocks while the queue is
+    full. Closing waits for the queue to drain, prints the throughput, and raises the first failed
+    upload. Progress is printed every report_secs.
+    """
+
+    def __init__(self, bucket, max_workers=S3_UPLOAD_MAX_WORKERS, max_queued=S3_UPLOAD_QUEUE_SIZE, report_secs=10):
+
+        self.bucket = bucket
+        self.client = get_s3_client()
+        self.report_secs = report_secs
+
+        self.stats = {'files': 0, 'bytes': 0, 'secs': 0.0, 'retries': 0}
+        self.errors = []
+        self.queued_count = 0
+        self.lock = threading.Lock()
+        self.start_time = self.last_report_time = time.time()
+
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.threads = [threading.Thread(target=self.__upload, daemon=True) for _ in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # don't hide the producer's own error behind an upload failure
+        self.close(raise_errors=exc_type is None)
+
+    def put(self, body, object_key):
+
+        self.queue.put((body, object_key))
+        self.queued_count += 1
+
+    def close(self, raise_errors=True):
+
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        self.stats['secs'] = round(time.time() - self.start_time, 3)
+        print(f'\tuploaded {self.stats["files"]} files to s3://{self.bucket}, {self.__get_throughput(self.stats["secs"])}, {self.stats["retries"]} retries')
+
+        if self.errors:
+            print(f'\t{len(self.errors)} uploads failed')
+            if raise_errors:
+                raise self.errors[0]
+
+        return self.stats
+
+    def __upload(self):
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            body, object_key = item
+            try:
+                response = self.client.put_object(Body=body, Bucket=self.bucket, Key=object_key)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+                continue
+
+            with self.lock:
+                self.stats['files'] += 1
+                self.stats['bytes'] += len(body)
+                self.stats['retries'] += response['ResponseMetadata'].get('RetryAttempts', 0)
+
+                if time.time() - self.last_report_time >= self.report_secs:
+                    self.last_report_time = time.time()
+                    print(f'\t{self.stats["files"]}/{self.queued_count} files, {self.__get_throughput(self.last_report_time - self.start_time)}')
+
+    def __get_throughput(self, secs):
+
+        secs = max(secs, 1e-6)
+        return f'{self.stats["bytes"] / 1e6:.1f} MB in {secs:.1f} s, {self.stats["files"] / secs:.0f} files/s, {self.stats["bytes"] / 1e6 / secs:.1f} MB/s'
+
+
+def get_item(bucket, object_key):
+    """
+    Returns (body, last_modified) for an object, or None if it doesn't exist.
+    """
+
+    client = get_s3_client()
+    try:
+        response = client.get_object(Bucket=bucket, Key=object_key)
+    except client.exceptions.NoSuchKey:
+        return None
+
+    return response['Body'].read(), response['LastModified']
 
 
+def put_item_body(body, bucket, object_key):
+    get_s3_client().put_object(Body=body, Bucket=bucket, Key=object_key)
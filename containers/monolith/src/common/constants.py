@@ -3,12 +3,53 @@ DAYS_BUFFER = 80
 
 MAX_CLOUD_COVER = 80
 
+DOWNLOAD_MAX_WORKERS = 16 # concurrent windowed COG reads
+
+SCORING_MAX_WORKERS = 16 # concurrent SCL reads when ranking scenes
+
+CLOUD_MASK_BUFFER_SIZE = 20 # footprint size of the buffer around masked pixels
+CLOUD_MASK_TILE_SIZE = 1024
+CLOUD_MASK_TILE_OVERLAP = 64
+CLOUD_MASK_BATCH_SIZE = 4 # tiles per forward pass, across scenes
+
+COMPOSITE_BLOCK_ROWS = 512 # rows of the mosaic held in memory by merge_scenes
+
+LANDCOVER_TILE_SIZE = 1024
+LANDCOVER_TILE_OVERLAP = 64
+
+MAP_TILES_CHUNK_LEVELS = 3 # zooms rendered together from one warped window, 3 is 8 x 8 tiles
+MAP_TILES_MIN_PIXELS = 64 # the lowest zoom shows the region at least this many pixels across
+MAP_TILES_FORMAT = 'png' # or pmtiles, one archive per pyramid instead of a png per tile
+MAP_TILES_DEDUPLICATE = False # store identical tiles once, listed in manifest.json, only for clients that read it
+
+MODEL_BACKEND = 'torch' # or onnx, which runs the exported models with onnxruntime
+MODEL_TORCHSCRIPT = False # trace and freeze models when they are loaded
+MODEL_PRECISION = 'fp32' # one of fp32, bf16, int8_dynamic, int8_static, see benchmarks/eval_precision.py
+
+ONNX_INTRA_OP_THREADS = 0 # 0 uses every core
+
+PROCESS_POOL_START_METHOD = 'forkserver' # forking a process whose threads may hold GDAL or boto3 locks can deadlock the child
+
+PROFILE_RSS_INTERVAL_SECS = 0.05 # how often run reports sample RSS during a stage
+PROFILE_TRACEMALLOC = False # also trace Python and numpy allocations per stage, slows allocation-heavy stages
+
+RENDER_BLOCK_ROWS = 1024 # rows read at once when rendering byte tifs and previews
+RENDER_PREVIEW_MAX_SIZE = 2048 # preview PNGs are subsampled to at most this many pixels across
+
 NODATA_BYTE = 255
 NODATA_FLOAT32 = -9999
 
 S2_BANDS_TIFF_ORDER = ['B02', 'B03', 'B04', 'B08', 'SCL'] # make sure SCL last
 
 S3_DATA_BUCKET = 'smartcarte-data'
+S3_UPLOAD_MAX_WORKERS = 32 # concurrent PUTs, the shared client pools as many connections
+S3_UPLOAD_QUEUE_SIZE = 256 # files waiting for an upload thread before producers block
+S3_MAX_ATTEMPTS = 6 # per request, retried with exponential backoff
+
+STAC_API_URL = 'https://earth-search.aws.element84.com/v0'
+STAC_CACHE_DIR = '/tmp/stac_cache'
+STAC_CACHE_S3_PREFIX = 'cache/stac'
+STAC_CACHE_TTL_SECS = 6 * 60 * 60
 
 API_BASE_URL = 'https://api.smartcarte.earth'
 
@@ -25,6 +25,9 @@ def update_demo_classification_task(task_uid, **kwargs):
         "imagery_tiles_href": kwargs.get('imagery_tiles_href'),
         "landcover_tif_href": kwargs.get('landcover_tif_href'),
         "landcover_tiles_href": kwargs.get('landcover_tiles_href'),
+        # only sent for deduplicated pyramids, requests leaves out None values
+        "imagery_tiles_manifest_href": kwargs.get('imagery_tiles_manifest_href'),
+        "landcover_tiles_manifest_href": kwargs.get('landcover_tiles_manifest_href'),
         "rgb_tif_href": kwargs.get('rgb_tif_href'),
     }
 
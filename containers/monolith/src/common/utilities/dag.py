@@ -0,0 +1,149 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack, nullcontext
+import multiprocessing
+import sentry_sdk
+import time
+
+from common.constants import PROCESS_POOL_START_METHOD
+
+
+def stage(name, func, after=(), inputs=(), uses=None, pool='thread', pixels=None):
+    """
+    Declares a stage for run_stages. func is called once every stage named in after or inputs
+    has finished, with the results of the inputs stages as arguments. uses maps resource names
+    to the amount the stage holds while it runs, e.g. {'cpu': 4}. Stages with pool='process' run
+    func in a worker process, so func and its result must pickle.
+    """
+
+    return {'name': name, 'func': func, 'after': tuple(after) + tuple(inputs), 'inputs': tuple(inputs), 'uses': dict(uses or {}), 'pool': pool, 'pixels': pixels}
+
+
+def run_stages(stages, limits=None, report=None, max_workers=None):
+    """
+    Runs stages as soon as their dependencies have finished and the resources they use fit in
+    limits, which maps resource names to capacities. Resources missing from limits are
+    unlimited, and a stage asking for more than a capacity gets all of it. Each stage is measured
+    in report when one is given, without allocation tracing as stages overlap.
+
+    Returns {name: result}. If a stage fails no more are started, and the first error is raised
+    once the running ones finish. Prints the critical path, which is also added to the report.
+    """
+
+    stages = {stage['name']: stage for stage in stages}
+    order = __get_topological_order(stages)
+    limits = dict(limits or {})
+    available = dict(limits)
+
+    results, timings, errors = {}, {}, []
+    pending, running = list(order), {}
+    hub = sentry_sdk.Hub.current
+
+    with ExitStack() as stack:
+        threads = stack.enter_context(ThreadPoolExecutor(max_workers=max_workers or len(stages)))
+        if report is not None:
+            stack.enter_context(report.concurrent_stages())
+        processes = None
+        if any(stages[name]['pool'] == 'process' for name in order):
+            processes = stack.enter_context(ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(PROCESS_POOL_START_METHOD)))
+
+        while pending or running:
+
+            for name in list(pending):
+                uses = __get_uses(stages[name], limits)
+                ready = all(dep in results for dep in stages[name]['after'])
+                if errors or not ready or any(available[resource] < amount for resource, amount in uses.items()):
+                    continue
+
+                for resource, amount in uses.items():
+                    available[resource] -= amount
+                pending.remove(name)
+                args = [results[dep] for dep in stages[name]['inputs']]
+                running[threads.submit(__run_stage, stages[name], args, processes, report, hub)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                for resource, amount in __get_uses(stages[name], limits).items():
+                    available[resource] += amount
+
+                try:
+                    results[name], timings[name] = future.result()
+                except Exception as e:
+                    print(f'stage {name} failed: {e}')
+                    errors.append(e)
+
+    if errors:
+        raise errors[0]
+
+    critical_path = get_critical_path(stages, timings)
+    print('critical path: ' + ' -> '.join(f'{name} ({timings[name][1] - timings[name][0]:.1f} s)' for name in critical_path))
+    if report is not None:
+        report.set_context(critical_path=critical_path)
+
+    return results
+
+
+def get_critical_path(stages, timings):
+    """
+    The chain of stages that decided when the run finished, from the first to the last. Starting
+    at the stage that ended last, each step goes back to the dependency that ended last.
+    """
+
+    if not timings:
+        return []
+
+    name = max(timings, key=lambda name: timings[name][1])
+    path = [name]
+    while stages[name]['after']:
+        name = max(stages[name]['after'], key=lambda dep: timings[dep][1])
+        path.append(name)
+
+    return path[::-1]
+
+
+def __run_stage(stage, args, processes, report, hub):
+
+    # runs on a pool thread, which needs the caller's hub for its span to join the transaction
+    with sentry_sdk.Hub(hub):
+        with report.stage(stage['name'], pixels=stage['pixels']) if report is not None else nullcontext():
+            start_time = time.time()
+            if stage['pool'] == 'process':
+                result = processes.submit(stage['func'], *args).result()
+            else:
+                result = stage['func'](*args)
+
+    return result, (start_time, time.time())
+
+
+def __get_uses(stage, limits):
+
+    # resources without a limit aren't tracked, and no stage can wait for more than there is
+    return {resource: min(amount, limits[resource]) for resource, amount in stage['uses'].items() if resource in limits}
+
+
+def __get_topological_order(stages):
+
+    order, visiting, visited = [], set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f'stage {name} is in a dependency cycle')
+        if name not in stages:
+            raise ValueError(f'unknown stage {name}')
+
+        visiting.add(name)
+        for dep in stages[name]['after']:
+            visit(dep)
+        visiting.remove(name)
+        visited.add(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+
+    return order
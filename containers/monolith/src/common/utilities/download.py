@@ -1,31 +1,33 @@
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import numpy as np
 import os
-from osgeo import gdal
 from pystac import ItemCollection
-from pystac_client import Client
 import rasterio
 import rasterio.merge
 import requests
 from shapely.geometry import box, shape
+import time
 import xml.etree.ElementTree as ET
 
 from common.exceptions import EmptyCollectionException, IncompleteCoverageException, NotEnoughItemsException
-from common.constants import NODATA_FLOAT32, S2_BANDS_TIFF_ORDER
-from common.utilities.imagery import merge_scenes, normalize_original_s2_array, write_array_to_tif
-from common.utilities.masking import apply_cloud_mask
+from common.constants import DOWNLOAD_MAX_WORKERS, NODATA_FLOAT32, S2_BANDS_TIFF_ORDER, SCORING_MAX_WORKERS
+from common.utilities.imagery import merge_scenes, normalize_original_s2_array, warp_array, write_array_to_tif
+from common.utilities.masking import apply_cloud_mask, predict_nn_cloud_masks
+from common.utilities.profiling import RunReport, get_raster_pixels
 from common.utilities.projections import get_collection_bbox_coverage, reproject_shape
+from common.utilities.stac import search_items
 
 
-def get_cloud_freeish_collection(start_date, end_date, bbox, dst_path):
+def get_cloud_freeish_collection(start_date, end_date, bbox, dst_path, max_workers=SCORING_MAX_WORKERS):
     
+    # windows a failed earlier task in this process left behind
+    clear_scene_windows()
+
     stac_date_format = '%Y-%m-%dT%H:%M:%SZ'
     stac_date_string = start_date.strftime(stac_date_format) + '/' + end_date.strftime(stac_date_format)
 
-    # Open a catalog
-    client = Client.open("https://earth-search.aws.element84.com/v0")
-
-    # Get results for a collection in the catalog
-    search = client.search(
+    # Get results for a collection in the catalog, paged once or served from the cache
+    search_results = search_items(
         bbox=bbox,
         collections=['sentinel-s2-l2a-cogs'], 
         datetime=stac_date_string,
@@ -38,18 +40,21 @@ def get_cloud_freeish_collection(start_date, end_date, bbox, dst_path):
         },
     )
 
-    if len(list(search.items())) == 0:
+    if len(search_results) == 0:
         raise EmptyCollectionException(f'no items in {bbox}')
 
+    # score every scene's SCL window concurrently, results come back in search order
+    bbox_poly_ll = box(*bbox)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        cloud_ratios = list(executor.map(lambda item: get_scene_cloud_ratio(item, bbox_poly_ll), search_results))
+
     # group items by grid square
     groups = {}
-    bbox_poly_ll = box(*bbox)
-    for item in list(search.items()):
+    for item, cloud_ratio in zip(search_results, cloud_ratios):
         square = item.properties['sentinel:grid_square']
         if square not in groups:
             groups[square] = []
 
-        cloud_ratio = get_scene_cloud_ratio(item, bbox_poly_ll)
         if cloud_ratio < 0.80:
             groups[square].append((item, cloud_ratio))
 
@@ -64,6 +69,9 @@ def get_cloud_freeish_collection(start_date, end_date, bbox, dst_path):
         print(square, len(square_items))
         items.extend([x[0] for x in square_items[:max_items]])
 
+    # keep the SCL windows of selected scenes around for download_collection
+    retain_scene_windows([item.assets['SCL'].href for item in items])
+
     collection = ItemCollection(items=items)
     collection.save_object(dst_path)
     return collection
@@ -71,18 +79,13 @@ def get_cloud_freeish_collection(start_date, end_date, bbox, dst_path):
 
 def get_scene_cloud_ratio(item, bbox_poly_ll):
     
-    item_epsg_int = int(item.properties["proj:epsg"])
-    item_epsg_str = f'EPSG:{item_epsg_int}'       
-
-    scene_poly_ll = shape(item.geometry)
-    overlap_poly_ll = bbox_poly_ll.intersection(scene_poly_ll)
-
-    overlap_poly_utm = reproject_shape(overlap_poly_ll, init_proj="EPSG:4326", target_proj=item_epsg_str)
-    overlap_bbox_utm = np.round(overlap_poly_utm.bounds  , -1)        
-    overlap_poly_utm = box(*overlap_bbox_utm)
+    overlap_bbox_utm = get_scene_overlap_bbox_utm(item, bbox_poly_ll)
     
     scl_href = item.assets['SCL'].href
     scl_data, scl_transform = download_bbox(overlap_bbox_utm, scl_href)
+
+    # download_collection reads the same window again if the scene is selected
+    __scene_windows[(scl_href, tuple(overlap_bbox_utm))] = (scl_data, scl_transform)
     
     cloud_mask = np.isin(scl_data, [3, 8, 9, 10, 11]) 
     cloud_ratio = np.mean(cloud_mask)
@@ -90,6 +93,41 @@ def get_scene_cloud_ratio(item, bbox_poly_ll):
     return cloud_ratio
 
 
+def get_scene_overlap_bbox_utm(item, bbox_poly_ll):
+    """
+    Bounds of the bbox and scene intersection in the scene's UTM zone, rounded to the nearest 10 meters.
+    """
+
+    item_epsg_str = f'EPSG:{int(item.properties["proj:epsg"])}'
+
+    scene_poly_ll = shape(item.geometry) # polygon of the entire scene
+    overlap_poly_ll = bbox_poly_ll.intersection(scene_poly_ll) # polygon of intersection between entire scene and bbox
+
+    overlap_poly_utm = reproject_shape(overlap_poly_ll, init_proj="EPSG:4326", target_proj=item_epsg_str)
+    return np.round(overlap_poly_utm.bounds, -1)
+
+
+### per-task scene window cache ###
+
+__scene_windows = {}
+
+
+def pop_scene_window(href, bbox):
+    return __scene_windows.pop((href, tuple(bbox)), None)
+
+
+def retain_scene_windows(hrefs):
+
+    hrefs = set(hrefs)
+    for key in list(__scene_windows):
+        if key[0] not in hrefs:
+            del __scene_windows[key]
+
+
+def clear_scene_windows():
+    __scene_windows.clear()
+
+
 def get_collection(start_date, end_date, bbox, dst_path, max_cloud_cover=20, max_tile_count=6, min_tile_count=3):
         
     assert end_date > start_date
@@ -97,11 +135,8 @@ def get_collection(start_date, end_date, bbox, dst_path, max_cloud_cover=20, max
     stac_date_format = '%Y-%m-%dT%H:%M:%SZ'
     stac_date_string = start_date.strftime(stac_date_format) + '/' + end_date.strftime(stac_date_format)
 
-    # Open a catalog
-    client = Client.open("https://earth-search.aws.element84.com/v0")
-
     # Get results for a collection in the catalog
-    search = client.search(
+    search_results = search_items(
         bbox=bbox,
         collections=['sentinel-s2-l2a-cogs'], 
         datetime=stac_date_string,
@@ -116,7 +151,7 @@ def get_collection(start_date, end_date, bbox, dst_path, max_cloud_cover=20, max
 
     # limit number of images per Sentinel grid square
     items, items_count = [], {}
-    for item in list(search.items()):
+    for item in search_results:
         square = item.properties['sentinel:grid_square']
         count = items_count.get(square, 0)
         if count < max_tile_count:
@@ -159,31 +194,52 @@ def get_scene_metadata(href):
     }
 
 
-def get_processed_composite(collection, bbox, dst_dir, cloud_mask_model_path):
+def get_processed_composite(collection, bbox, dst_dir, cloud_mask_model_path, report=None):
+
+    if report is None:
+        report = RunReport()
 
     composite_path = f'{dst_dir}/composite.tif'
 
     res = 10 / (111.32 * 1000) # about 10m in degrees
 
-    original_scenes = download_collection(collection, bbox, S2_BANDS_TIFF_ORDER, dst_dir, res)
-    
-    masked_scenes = {}
-    for scene in original_scenes:        
-        print(f'\tmasking... {scene}')
-
-        scene_dir = f'{dst_dir}/{scene}'   
-        meta = original_scenes[scene]['meta']
+    with report.stage('download') as stage:
+        try:
+            original_scenes = download_collection(collection, bbox, S2_BANDS_TIFF_ORDER, dst_dir, res)
+        finally:
+            # windows of scenes with a stack already on disk are never popped
+            clear_scene_windows()
+        stage['pixels'] = get_raster_pixels(*[original_scenes[scene]['stack_original_tif_path'] for scene in original_scenes])
+
+    report.set_context(scene_count=len(original_scenes))
+
+    with report.stage('masking', pixels=stage['pixels']):
+        # the cloud model runs over every scene together so tiles from different scenes share batches
+        nn_cloud_mask_paths = predict_nn_cloud_masks(
+            {scene: original_scenes[scene]['stack_original_tif_path'] for scene in original_scenes},
+            cloud_mask_model_path
+        )
         
-        stack_original_tif_path = original_scenes[scene]['stack_original_tif_path']    # 1. original, normalized
-        stack_masked_tif_path = f'{scene_dir}/stack_masked.tif'                        # 2. masked
+        masked_scenes = {}
+        for scene in original_scenes:        
+            print(f'\tmasking... {scene}')
 
-        if not apply_cloud_mask(stack_original_tif_path, meta, stack_masked_tif_path, cloud_mask_model_path):
-            print(f'\t\tskipping {scene}, too many clouds')
-            continue
-        
-        masked_scenes[scene] = stack_masked_tif_path
-        
-    merge_scenes(masked_scenes, composite_path)
+            scene_dir = f'{dst_dir}/{scene}'   
+            meta = original_scenes[scene]['meta']
+            
+            stack_original_tif_path = original_scenes[scene]['stack_original_tif_path']    # 1. original, normalized
+            stack_masked_tif_path = f'{scene_dir}/stack_masked.tif'                        # 2. masked
+
+            if not apply_cloud_mask(stack_original_tif_path, meta, stack_masked_tif_path, cloud_mask_model_path, nn_cloud_mask_path=nn_cloud_mask_paths[scene]):
+                print(f'\t\tskipping {scene}, too many clouds')
+                continue
+            
+            masked_scenes[scene] = stack_masked_tif_path
+
+    report.set_context(masked_scene_count=len(masked_scenes))
+
+    with report.stage('merge', pixels=get_raster_pixels(*masked_scenes.values())):
+        merge_scenes(masked_scenes, composite_path)
 
     return composite_path
 
@@ -206,66 +262,114 @@ def download_bbox(bbox, cog_url, read_all=False):
     
 
 
-def download_collection(collection, bbox, bands, dst_dir, res):
+def download_collection(collection, bbox, bands, dst_dir, res, max_workers=DOWNLOAD_MAX_WORKERS):
 
     bbox_poly_ll = box(*bbox)
-       
-    scenes = {}
-    for item in list(collection):
-        
-        print(f'\tdownloading... {item.id}')
+    start_time = time.time()
 
-        scenes[item.id] = {}
-        band_hrefs = [item.assets[band].href for band in bands]
-        scenes[item.id]['meta'] = get_scene_metadata(item.assets['metadata'].href)
-        
-        # reproject bbox into UTM zone of S2 scene 
-        item_epsg_int = int(item.properties["proj:epsg"])
-        item_epsg_str = f'EPSG:{item_epsg_int}'       
-        
-        # get intersection of bbox and S2 scene for windowed read
-        scene_poly_ll = shape(item.geometry) # polygon of the entire scene
-        overlap_poly_ll = bbox_poly_ll.intersection(scene_poly_ll) # polygon of intersection between entire scene and bbox
-        
-        # reproject overlap polygon into UTM and round to nearest 10 meter
-        overlap_poly_utm = reproject_shape(overlap_poly_ll, init_proj="EPSG:4326", target_proj=item_epsg_str)
-        overlap_bbox_utm = np.round(overlap_poly_utm.bounds  , -1)        
-        overlap_poly_utm = box(*overlap_bbox_utm)
-        
-        overlap_poly_ll = reproject_shape(overlap_poly_utm, init_proj=item_epsg_str, target_proj="EPSG:4326")
-        overlap_bbox_ll = list(overlap_poly_ll.bounds)
-        
-        scene_dir = f'{dst_dir}/{item.id}'
-        stack_original_tif_path = f'{scene_dir}/stack_original.tif'
-        
-        if os.path.exists(stack_original_tif_path):
-            scenes[item.id]['stack_original_tif_path'] = stack_original_tif_path
-            continue
+    scenes, pending, owners = {}, {}, {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
 
-        if not os.path.exists(scene_dir):
-            os.mkdir(scene_dir)
-        
-        band_tif_paths = []               
-        for s3_href in band_hrefs:                        
-            band_name = s3_href.split('/')[-1].split('.')[0]
-            band_path = f'{scene_dir}/{band_name}.tif'
-            
-            s3_data, s3_transform = download_bbox(overlap_bbox_utm, s3_href)
-            s3_data = normalize_original_s2_array(s3_data)
-                                    
-            write_array_to_tif(s3_data, band_path, overlap_bbox_utm, dtype=np.float32, epsg=item_epsg_int, nodata=NODATA_FLOAT32, transform=s3_transform)
-            gdal.Warp(band_path, band_path, dstSRS="EPSG:4326", xRes=res, yRes=res, outputBounds=overlap_bbox_ll)
+        # queue every metadata request and band window of every scene up front
+        for item in list(collection):
+
+            print(f'\tdownloading... {item.id}')
+
+            scenes[item.id] = {}
+            band_hrefs = [item.assets[band].href for band in bands]
 
-            band_tif_paths.append(band_path)
+            # reproject bbox into UTM zone of S2 scene 
+            item_epsg_int = int(item.properties["proj:epsg"])
+            item_epsg_str = f'EPSG:{item_epsg_int}'       
+            
+            # get intersection of bbox and S2 scene for windowed read, in UTM and rounded to nearest 10 meter
+            overlap_bbox_utm = get_scene_overlap_bbox_utm(item, bbox_poly_ll)
+            overlap_poly_utm = box(*overlap_bbox_utm)
+            
+            overlap_poly_ll = reproject_shape(overlap_poly_utm, init_proj=item_epsg_str, target_proj="EPSG:4326")
+            overlap_bbox_ll = list(overlap_poly_ll.bounds)
             
-        stack_data = []
-        for path in band_tif_paths:
-            with rasterio.open(path) as src:
-                stack_data.append(src.read(1))
-                
-        stack_data = np.array(stack_data).transpose((1, 2, 0))     
-        write_array_to_tif(stack_data, stack_original_tif_path, overlap_bbox_ll, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32)        
-        scenes[item.id]['stack_original_tif_path'] = stack_original_tif_path
+            scene_dir = f'{dst_dir}/{item.id}'
+            stack_original_tif_path = f'{scene_dir}/stack_original.tif'
+
+            futures = [executor.submit(__timed, get_scene_metadata, item.assets['metadata'].href)]
+            if not os.path.exists(stack_original_tif_path):
+                futures += [__get_band_future(executor, overlap_bbox_utm, href) for href in band_hrefs]
+
+            pending[item.id] = {
+                'epsg': item_epsg_int,
+                'futures': futures,
+                'overlap_bbox_ll': overlap_bbox_ll,
+                'remaining': len(futures),
+                'scene_dir': scene_dir,
+                'stack_original_tif_path': stack_original_tif_path,
+            }
+            for future in futures:
+                owners[future] = item.id
+
+        # build each scene's stack as soon as all of its reads have landed
+        for future in as_completed(owners):
+
+            item_id = owners[future]
+            scene = pending[item_id]
+            scene['remaining'] -= 1
+            if scene['remaining'] > 0:
+                continue
+
+            results = [f.result() for f in scene['futures']]
+            scenes[item_id]['meta'] = results[0][0]
+
+            download_secs = max(r[2] for r in results) - min(r[1] for r in results)
+            scenes[item_id]['timings'] = {'download': download_secs}
+
+            if len(results) > 1:
+                stack_start = time.time()
+                __write_scene_stack(scene, [r[0] for r in results[1:]], res)
+                scenes[item_id]['timings']['stack'] = time.time() - stack_start
+
+            scenes[item_id]['stack_original_tif_path'] = scene['stack_original_tif_path']
+            del pending[item_id]
+
+            print(f'\tdownloaded {item_id} in {download_secs:.2f} seconds')
+
+    print(f'\tdownloaded {len(scenes)} scenes in {time.time() - start_time:.2f} seconds')
 
     return scenes
 
+
+def __get_band_future(executor, bbox, href):
+
+    # reuse the window scene selection already pulled, usually SCL
+    window = pop_scene_window(href, bbox)
+    if window is None:
+        return executor.submit(__timed, download_bbox, bbox, href)
+
+    future = Future()
+    now = time.time()
+    future.set_result((window, now, now))
+    return future
+
+
+def __timed(func, *args):
+
+    start = time.time()
+    result = func(*args)
+    return result, start, time.time()
+
+
+def __write_scene_stack(scene, band_windows, res):
+
+    scene_dir = scene['scene_dir']
+    overlap_bbox_ll = scene['overlap_bbox_ll']
+
+    if not os.path.exists(scene_dir):
+        os.mkdir(scene_dir)
+
+    # reproject every band window in memory and write the stack once
+    stack_data = []
+    for s3_data, s3_transform in band_windows:
+        s3_data = normalize_original_s2_array(s3_data)
+        stack_data.append(warp_array(s3_data, s3_transform, scene['epsg'], overlap_bbox_ll, res))
+            
+    stack_data = np.array(stack_data).transpose((1, 2, 0))     
+    write_array_to_tif(stack_data, scene['stack_original_tif_path'], overlap_bbox_ll, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32)        
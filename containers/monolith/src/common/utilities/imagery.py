@@ -1,4 +1,7 @@
-import gdal2tiles
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
+import multiprocessing
 import numpy as np
 import os
 from osgeo import gdal, osr
@@ -6,11 +9,11 @@ import rasterio
 import rasterio.merge
 from rasterio.windows import Window
 import shutil
-from skimage import exposure
 import warnings
 
-from common.constants import LANDCOVER_COLORS, NODATA_FLOAT32
+from common.constants import COMPOSITE_BLOCK_ROWS, LANDCOVER_COLORS, NODATA_BYTE, NODATA_FLOAT32, PROCESS_POOL_START_METHOD, RENDER_BLOCK_ROWS, RENDER_PREVIEW_MAX_SIZE
 from common.exceptions import NotEnoughItemsException
+from common.utilities.visualization import save_image
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
@@ -55,7 +58,11 @@ def create_blank_tif(bbox, dst_dir=None, dst_path=None, dtype=gdal.GDT_Float32,
     return dst_path
 
             
-def create_composite_from_paths(stack_paths, dst_path, nodata=NODATA_FLOAT32):
+def create_composite_from_paths(stack_paths, dst_path, nodata=NODATA_FLOAT32, block_rows=COMPOSITE_BLOCK_ROWS, max_workers=None):
+    """
+    Median composite of stacks on the same grid. Row blocks are farmed out to a process pool whose
+    workers open every stack once, and are written in order as they come back.
+    """
     
     if len(stack_paths) == 0:
         return False
@@ -65,44 +72,70 @@ def create_composite_from_paths(stack_paths, dst_path, nodata=NODATA_FLOAT32):
         return True
     
     with rasterio.open(stack_paths[0]) as src:
-        band_count = src.count
         meta = src.meta.copy()
         nrows, ncols = src.height, src.width
-        # nrows, ncols = src.shape[0], src.shape[1]        
     
+    windows = [Window(0, row, ncols, min(block_rows, nrows - row)) for row in range(0, nrows, block_rows)]
+
     with rasterio.open(dst_path, 'w', **meta) as dst:   
-        
-        # process batch_size rows at a time
-        batch_size = 1600
-        for row in np.arange(0, nrows, batch_size):
-            
-            # current bsize is batch_size unless we are near the end of the file
-            bsize = nrows - row if row + batch_size > nrows else batch_size
-            window = Window(0, row, ncols, bsize)
-
-            # loop through each stack and read the data into a list
-            batch_data = []
-            for path in stack_paths:
-                with rasterio.open(path) as src:
-                    data = src.read(masked=True, window=window)   
-                    data[data.mask] = np.nan
-                    batch_data.append(data)
-        
-            # calculate the median of the batch along the 0th axis (band)
-            batch_data = np.array(batch_data)            
-            batch_centre = np.nanmedian(batch_data, axis=0)
-            # batch_centre = np.nanmean(batch_data, axis=0)
-
-            # write the data to the output file
-            for i in range(band_count):
-                band_data = batch_centre[i, :, :]
-                masked_data = np.nan_to_num(band_data, nan=nodata)
-                dst.write(masked_data, indexes=i+1, window=window)
+        mp_context = multiprocessing.get_context(PROCESS_POOL_START_METHOD)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=__open_median_sources, initargs=(stack_paths,)) as executor:
+
+            # map hands results back in window order
+            for window, block_median in zip(windows, executor.map(__get_block_median, windows)):
+                dst.write(np.nan_to_num(block_median, nan=nodata), window=window)
                 
     return True
+
+
+__median_sources = []
+
+
+def __open_median_sources(stack_paths):
+
+    # runs once in every worker, the stacks stay open for all the blocks it gets
+    global __median_sources
+    __median_sources = [rasterio.open(path) for path in stack_paths]
+
+
+def __get_block_median(window):
+
+    sources = __median_sources
+    block = np.empty((len(sources), sources[0].count, window.height, window.width), dtype=np.float32)
+    for i, src in enumerate(sources):
+        data = src.read(masked=True, window=window)
+        block[i] = data.filled(np.nan)
+
+    return get_nan_median(block)
+
+
+def get_nan_median(data):
+    """
+    np.nanmedian(data, axis=0), sorting data in place instead of copying it. NaNs sort last, so
+    each pixel's median sits between its valid count's middle entries on the short first axis.
+
+    A full sort is deliberate. Partitioning each valid count's pixels on their one or two middle
+    entries gives the same medians but was 1.3 to 2.6 times slower for 6 to 20 scenes, because
+    the scene axis is short and strided, see benchmarks/bench_median.py --kernels.
+    """
+
+    valid_count = data.shape[0] - np.isnan(data).sum(axis=0)
+    data.sort(axis=0)
+
+    low = np.take_along_axis(data, np.maximum(valid_count - 1, 0)[None] // 2, axis=0)[0]
+    high = np.take_along_axis(data, np.minimum(valid_count // 2, data.shape[0] - 1)[None], axis=0)[0]
+
+    median = np.where(valid_count % 2 == 1, low, (low + high) / np.float32(2))
+    median[valid_count == 0] = np.nan
+    return median
     
 
-def merge_scenes(scenes_dict, merged_path):
+def merge_scenes(scenes_dict, merged_path, block_rows=COMPOSITE_BLOCK_ROWS):
+    """
+    Mean composite of the masked scenes, pixel for pixel what summing and counting them with
+    rasterio.merge.merge gives. The mosaic is built block_rows rows at a time, each block reads
+    its strip of every overlapping scene once, and is written before the next one starts.
+    """
 
     if len(scenes_dict) == 0:
         raise NotEnoughItemsException("No scenes to merge")
@@ -112,21 +145,110 @@ def merge_scenes(scenes_dict, merged_path):
         shutil.copy2(tif_path, merged_path)
         return
 
-    masked_sources = []
-    for scene in scenes_dict:
-        src = rasterio.open(scenes_dict[scene])
-        masked_sources.append(src)
-    
-    sum_data, sum_transform = rasterio.merge.merge(masked_sources, indexes=[1, 2, 3, 4], method="sum", nodata=NODATA_FLOAT32)  
-    sum_data = np.ma.array(sum_data, mask=(sum_data==NODATA_FLOAT32))
+    indexes = [1, 2, 3, 4]
 
-    count_data, count_transform = rasterio.merge.merge(masked_sources, indexes=[1, 2, 3, 4], method="count", nodata=NODATA_FLOAT32)  
-    count_data = np.ma.array(count_data, mask=(count_data==NODATA_FLOAT32))
-    
-    mean_data = sum_data / count_data    
-    mean_data = mean_data.transpose((1, 2, 0))
-    
-    write_array_to_tif(mean_data, merged_path, None, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32, transform=sum_transform) 
+    with ExitStack() as stack:
+        masked_sources = [stack.enter_context(rasterio.open(scenes_dict[scene])) for scene in scenes_dict]
+
+        height, width, transform = __get_mosaic_grid(masked_sources)
+        placements = [__get_mosaic_placement(src, transform, height, width) for src in masked_sources]
+
+        profile = {
+            "driver": "GTiff",
+            "height": height,
+            "width": width,
+            "count": len(indexes),
+            "dtype": np.float32,
+            "crs": rasterio.crs.CRS.from_epsg(4326),
+            "transform": transform,
+            "nodata": NODATA_FLOAT32,
+        }
+
+        with rasterio.open(merged_path, 'w', **profile) as dst:
+            for row in range(0, height, block_rows):
+                block_height = min(block_rows, height - row)
+
+                sum_data = np.zeros((len(indexes), block_height, width), dtype=np.float32)
+                count_data = np.zeros((len(indexes), block_height, width), dtype=np.float32)
+
+                for src, placement in zip(masked_sources, placements):
+                    if placement is not None:
+                        __accumulate_mosaic_block(src, placement, indexes, row, block_height, sum_data, count_data)
+
+                mean_data = np.full(sum_data.shape, NODATA_FLOAT32, dtype=np.float32)
+                np.divide(sum_data, count_data, out=mean_data, where=(count_data > 0))
+
+                dst.write(mean_data, window=Window(0, row, width, block_height))
+
+
+def __get_mosaic_grid(sources):
+
+    # the output grid rasterio.merge.merge lays out for these sources
+    xs, ys = [], []
+    for src in sources:
+        left, bottom, right, top = src.bounds
+        xs.extend([left, right])
+        ys.extend([bottom, top])
+    dst_w, dst_s, dst_e, dst_n = min(xs), min(ys), max(xs), max(ys)
+
+    res = sources[0].res
+    width = int(round((dst_e - dst_w) / res[0]))
+    height = int(round((dst_n - dst_s) / res[1]))
+    transform = rasterio.transform.Affine.translation(dst_w, dst_n) * rasterio.transform.Affine.scale(res[0], -res[1])
+
+    return height, width, transform
+
+
+def __get_mosaic_placement(src, transform, height, width):
+
+    # where rasterio.merge.merge reads a source from and pastes it into the output grid
+    dst_w, dst_n = transform.c, transform.f
+    dst_e, dst_s = dst_w + width * transform.a, dst_n + height * transform.e
+
+    if rasterio.coords.disjoint_bounds((dst_w, dst_s, dst_e, dst_n), src.bounds):
+        return None
+
+    src_w, src_s, src_e, src_n = src.bounds
+    int_w, int_s = max(src_w, dst_w), max(src_s, dst_s)
+    int_e, int_n = min(src_e, dst_e), min(src_n, dst_n)
+
+    src_window = rasterio.windows.from_bounds(int_w, int_s, int_e, int_n, src.transform).round_lengths()
+    dst_window = rasterio.windows.from_bounds(int_w, int_s, int_e, int_n, transform).round_lengths().round_offsets()
+
+    row_off, col_off = max(0, dst_window.row_off), max(0, dst_window.col_off)
+    return {
+        'src_window': src_window,
+        'read_height': dst_window.height,
+        'read_width': dst_window.width,
+        'row_off': row_off,
+        'col_off': col_off,
+        'height': min(dst_window.height, height - row_off),
+        'width': min(dst_window.width, width - col_off),
+    }
+
+
+def __accumulate_mosaic_block(src, placement, indexes, row, block_height, sum_data, count_data):
+
+    # rows of the pasted source that fall in this block
+    start = max(row - placement['row_off'], 0)
+    stop = min(row + block_height - placement['row_off'], placement['height'])
+    if start >= stop:
+        return
+
+    # the matching strip of the source window, scaled like the single full read would be
+    src_window = placement['src_window']
+    row_scale = src_window.height / placement['read_height']
+    strip = Window(src_window.col_off, src_window.row_off + start * row_scale, src_window.width, (stop - start) * row_scale)
+
+    data = src.read(indexes, out_shape=(len(indexes), stop - start, placement['read_width']), window=strip, masked=True)
+    data = data[:, :, :placement['width']]
+    valid = ~np.ma.getmaskarray(data)
+
+    block_rows = slice(placement['row_off'] + start - row, placement['row_off'] + stop - row)
+    block_cols = slice(placement['col_off'], placement['col_off'] + placement['width'])
+
+    np.add(sum_data[:, block_rows, block_cols], data.data, out=sum_data[:, block_rows, block_cols], where=valid)
+    count_data[:, block_rows, block_cols] += valid
 
 
 def merge_stack_with_blank(stack_path, blank_path, bbox, res, merged_path=None):  
@@ -190,52 +312,163 @@ def normalize_tif(tif_path, dst_path=None):
     write_array_to_tif(norm_data, dst_path, bbox, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32)
 
 
+def warp_array(data, transform, epsg, dst_bbox, res, dst_epsg=4326, nodata=NODATA_FLOAT32):
+    """
+    Warps a 2D array with gdal.Warp entirely in memory. Gives the same pixels as writing the
+    array with write_array_to_tif and warping that file, without the GeoTIFF round trips.
+    """
+
+    data = np.ma.filled(data, nodata).astype(np.float32) # masked values become nodata, like rasterio's write
+    height, width = data.shape
+
+    spatref = osr.SpatialReference()
+    spatref.ImportFromEPSG(epsg)
+
+    src_ds = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Float32)
+    src_ds.SetProjection(spatref.ExportToWkt())
+    src_ds.SetGeoTransform(transform.to_gdal())
+    src_band = src_ds.GetRasterBand(1)
+    src_band.SetNoDataValue(nodata)
+    src_band.WriteArray(data)
+
+    dst_ds = gdal.Warp('', src_ds, format='MEM', dstSRS=f'EPSG:{dst_epsg}', xRes=res, yRes=res, outputBounds=dst_bbox)
+    warped = dst_ds.GetRasterBand(1).ReadAsArray()
+
+    src_ds, dst_ds = None, None
+
+    return warped
+
+
 ### GeoTIFF creation ###
 
-def create_rgb_byte_tif_from_landcover(landcover_tif, dst_path, is_cog=False, use_alpha=False):
-    
-    with rasterio.open(landcover_tif) as src:
-        data = src.read(1, masked=True)
-        bbox = list(src.bounds)
+def create_rgb_byte_tifs_from_landcover(landcover_path, rgb_path=None, rgba_path=None, plot_path=None, is_cog=False, block_rows=RENDER_BLOCK_ROWS):
+    """
+    Colours the landcover classes into an RGB byte tif, an RGBA byte tif where unclassified
+    pixels are transparent and a preview PNG, whichever paths are given, in one pass over the
+    landcover tif.
+    """
 
-    rgb_stack = np.zeros((data.shape[0], data.shape[1], 3), dtype=np.uint8)
+    # class value to colour, unclassified and nodata stay black
+    colors = np.zeros((256, 3), dtype=np.uint8)
     for idx, info in LANDCOVER_COLORS.items():
-        rgb = info[0]
-        mask = (data == idx)
-        rgb_stack[mask] = rgb
-
-    if use_alpha:
-        alpha_mask = np.all(rgb_stack!=0, axis=2)
-        alpha = np.where(alpha_mask, 255, 0)
-        rgb_stack = np.stack((rgb_stack[:, :, 0], rgb_stack[:, :, 1], rgb_stack[:, :, 2], alpha), axis=2)
-    
-    write_array_to_tif(rgb_stack, dst_path, bbox, dtype=np.uint8, is_cog=is_cog, nodata=255)
-   
+        colors[idx] = info[0]
+    alphas = np.where(np.all(colors != 0, axis=1), 255, 0).astype(np.uint8)
+
+    def render(src, window):
+        data = src.read(1, window=window, masked=True).filled(0)
+        rgb = colors[data].transpose((2, 0, 1))
+        return rgb, np.concatenate([rgb, alphas[data][None]])
+
+    __render_byte_tifs(landcover_path, render, rgb_path, rgba_path, plot_path, is_cog, block_rows)
+
+
+def create_rgb_byte_tifs_from_composite(composite_path, rgb_path=None, rgba_path=None, plot_path=None, is_cog=False, block_rows=RENDER_BLOCK_ROWS):
+    """
+    Renders the composite's red, green and blue bands with a 0.6 gamma into an RGB byte tif, an
+    RGBA byte tif where nodata is transparent and a preview PNG, whichever paths are given, in
+    one pass over the composite.
+    """
+
+    thresholds = __get_gamma_thresholds(0.6, 254)
+
+    def render(src, window):
+        data = src.read((3, 2, 1), window=window, masked=True)
+        # nodata is negative, so it maps to 0 like any other reflectance below the first threshold
+        rgb = np.searchsorted(thresholds, data.data, side='right').astype(np.uint8)
+        mask = np.ma.getmaskarray(data)
+        alpha = np.where(mask[0], 0, 255).astype(np.uint8)
+        rgba = np.concatenate([rgb, alpha[None]])
+        rgb[mask] = NODATA_BYTE
+        return rgb, rgba
+
+    __render_byte_tifs(composite_path, render, rgb_path, rgba_path, plot_path, is_cog, block_rows)
+
+
+def create_rgb_byte_tif_from_landcover(landcover_tif, dst_path, is_cog=False, use_alpha=False):
+    create_rgb_byte_tifs_from_landcover(landcover_tif, **{'rgba_path' if use_alpha else 'rgb_path': dst_path}, is_cog=is_cog)
+
 
 def create_rgb_byte_tif_from_composite(composite_path, dst_path, is_cog=False, use_alpha=False):
-    
-    with rasterio.open(composite_path) as src:
-        bbox = list(src.bounds)
-        rgb_stack = src.read((3, 2, 1), masked=True)
-        rgb_mask = rgb_stack.mask[0, :, :]
-
-    gamma = 0.6
-    gamma_stack = np.zeros_like(rgb_stack)
-    for i in range(3):
-        channel = rgb_stack[i, :, :]
-        gamma_stack[i, :, :] = exposure.adjust_gamma(channel, gamma)
- 
-    rgb_stack = np.clip(gamma_stack * 254, 0, 254).astype(np.uint8)
-
-    if use_alpha:
-        alpha_mask = ~rgb_mask # 0 = transparent, 255 = opaque
-        alpha = np.where(alpha_mask, 255, 0)
-        rgb_stack = np.stack((rgb_stack[0, :, :], rgb_stack[1, :, :], rgb_stack[2, :, :], alpha), axis=0)
-    
-    rgb_stack = rgb_stack.transpose((1, 2, 0))
-    write_array_to_tif(rgb_stack, dst_path, bbox, dtype=np.uint8, is_cog=is_cog, nodata=255)
-   
-    
+    create_rgb_byte_tifs_from_composite(composite_path, **{'rgba_path' if use_alpha else 'rgb_path': dst_path}, is_cog=is_cog)
+
+
+@lru_cache()
+def __get_gamma_thresholds(gamma, scale):
+
+    # the smallest float32 reaching each byte value 1 to scale through the float gamma this
+    # replaced, np.clip(value ** gamma * scale, 0, scale).astype(np.uint8), so a searchsorted
+    # gives the same bytes without a power per pixel
+    def to_bytes(values):
+        return np.clip(values ** gamma * scale, 0, scale).astype(np.uint8)
+
+    levels = np.arange(1, scale + 1)
+    thresholds = ((levels / scale) ** (1 / gamma)).astype(np.float32)
+
+    while True:
+        low = to_bytes(thresholds) < levels
+        if not low.any():
+            break
+        thresholds = np.where(low, np.nextafter(thresholds, np.float32(np.inf)), thresholds)
+
+    while True:
+        lower = np.nextafter(thresholds, np.float32(-np.inf))
+        reached = to_bytes(lower) >= levels
+        if not reached.any():
+            break
+        thresholds = np.where(reached, lower, thresholds)
+
+    return thresholds
+
+
+def __render_byte_tifs(src_path, render, rgb_path, rgba_path, plot_path, is_cog, block_rows):
+
+    with rasterio.open(src_path) as src, ExitStack() as stack:
+        meta = {
+            "driver": "GTiff",
+            "height": src.height,
+            "width": src.width,
+            "dtype": np.uint8,
+            "crs": src.crs,
+            "transform": src.transform,
+            "nodata": NODATA_BYTE
+        }
+
+        outputs = {}
+        for key, dst_path, count in [(0, rgb_path, 3), (1, rgba_path, 4)]:
+            if dst_path is not None:
+                write_path = dst_path.replace('.tif', '_temp.tif') if is_cog else dst_path
+                outputs[key] = (dst_path, write_path, stack.enter_context(rasterio.open(write_path, "w", count=count, **meta)))
+
+        # every step-th row and column of the RGB for the preview, plotted at a few hundred pixels anyway
+        step = -(-max(src.height, src.width) // RENDER_PREVIEW_MAX_SIZE)
+        preview_rows = []
+
+        for row in range(0, src.height, block_rows):
+            window = Window(0, row, src.width, min(block_rows, src.height - row))
+            blocks = render(src, window)
+
+            for key, (_, _, dst) in outputs.items():
+                dst.write(blocks[key], window=window)
+
+            if plot_path is not None:
+                preview_rows.append(blocks[0][:, (-row) % step::step, ::step])
+
+    for dst_path, write_path, _ in outputs.values():
+        if is_cog:
+            __translate_to_cog(write_path, dst_path)
+
+    if plot_path is not None:
+        preview = np.concatenate(preview_rows, axis=1).transpose((1, 2, 0))
+        save_image(np.ma.masked_equal(preview, NODATA_BYTE), plot_path, cmap=None, vmin=None, vmax=None)
+
+
+def __translate_to_cog(write_path, dst_path):
+
+    translate_options = gdal.TranslateOptions(format="COG")
+    gdal.Translate(dst_path, write_path, options=translate_options)
+    os.remove(write_path)
+
+
 def write_array_to_tif(data, dst_path, bbox, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32, is_cog=False, transform=None):
         
     height, width = data.shape[0], data.shape[1]
@@ -281,30 +514,4 @@ def write_array_to_tif(data, dst_path, bbox, dtype=np.float32, epsg=4326, nodata
                 dst.write(band_data, indexes=i+1)
     
     if is_cog:
-        translate_options = gdal.TranslateOptions(format="COG")
-        gdal.Translate(dst_path, write_path, options=translate_options)
-        os.remove(write_path)
-
-
-### Map tile creation ###
-
-def create_map_tiles(file_path, tiles_dir, min_zoom=2, max_zoom=14):
-
-    print(f'generating tiles from {file_path} to {tiles_dir}/')
-
-    wb_file_path = file_path.replace('.tif', '_wm.tif')
-    gdal.Warp(wb_file_path, file_path, dstSRS="EPSG:3857")
-
-    options = {
-        'kml': True,
-        'nb_processes': 8,
-        'profile': 'mercator',
-        's_srs': 'EPSG:3857',
-        'tile_size': 256,
-        'title': 'Smart Carte',
-        'zoom': (min_zoom, max_zoom),
-    }
-
-    gdal2tiles.generate_tiles(wb_file_path, tiles_dir, **options)
-
-
+        __translate_to_cog(write_path, dst_path)
@@ -1,11 +1,18 @@
+from contextlib import ExitStack
 import numpy as np
+import os
 import rasterio
-from scipy.ndimage import maximum_filter
-import torch
+import time
 
 
-from common.constants import NODATA_FLOAT32
+from common.constants import CLOUD_MASK_BATCH_SIZE, CLOUD_MASK_BUFFER_SIZE, CLOUD_MASK_TILE_OVERLAP, CLOUD_MASK_TILE_SIZE, NODATA_FLOAT32
 from common.utilities.imagery import write_array_to_tif, create_rgb_byte_tif_from_composite
+from common.utilities.models import predict_batches, sigmoid
+from common.utilities.morphology import dilate, get_reach, or_shifted
+from common.utilities.tiling import get_core_slices, get_tile_windows, pad_to_shape, round_up_to_multiple
+
+
+CLOUD_HEIGHTS = np.arange(400, 1600, 200) # meters
 
 
 ### buffer around masked values ###
@@ -21,58 +28,62 @@ def __get_circular_mask(size):
     return mask
 
 
+def __get_buffer_reach(size):
+    return get_reach(__get_circular_mask(size))
+
+
 def __buffer_mask(mask, radius=12):
     
     kernel = __get_circular_mask(radius)
-    mask = maximum_filter(mask, footprint=kernel, mode='constant', cval=0)
+    mask = dilate(mask, kernel) # same as maximum_filter with the kernel, in linear time
     return mask
 
 
 ### cloud shadow and directional masking ###
 
-def __get_potential_shadow(cloud_height, azimuth_rad, zenith_rad, cloud_mask, scale=10):
+def __get_shadow_shift(cloud_height, azimuth_rad, zenith_rad, scale=10):
 
     shadow_vector = round(np.tan(zenith_rad) * cloud_height)
         
     x_shift = round(np.cos(azimuth_rad) * shadow_vector / scale)
     y_shift = round(np.sin(azimuth_rad) * shadow_vector / scale)
-    
-    shadows = np.roll(cloud_mask, y_shift, axis=0)
-    shadows = np.roll(shadows, x_shift, axis=1)
-    
-    if x_shift > 0:
-        shadows[:, :x_shift] = False
-    elif x_shift < 0:
-        shadows[:, x_shift:] = False
-
-    if y_shift > 0:
-        shadows[:y_shift, :] = False
-    elif y_shift < 0:
-        shadows[y_shift:, :] = False
-    
-    return shadows
+
+    return x_shift, y_shift
 
 
-def __get_cloud_shadow_mask(cloud_mask, azimuth, zenith):
+def __get_cloud_shadow_mask(cloud_mask, azimuth, zenith, cloud_heights=CLOUD_HEIGHTS):
+    """
+    Projects the cloud mask along the sun direction for each cloud height, ORing every shifted
+    copy into one output buffer. Heights that land on the same pixel shift are projected once,
+    so finer height sweeps cost no extra memory.
+    """
 
     # solar azimuth is opposite of illumination direction plus another 90 for the S2 instrument
     azimuth = azimuth - 270   
     azimuth_rad = np.deg2rad(azimuth)
     zenith_rad = np.deg2rad(zenith)
-        
-    cloud_heights = np.arange(400, 1600, 200) 
-    potential_shadow = np.array([
-        __get_potential_shadow(cloud_height, azimuth_rad, zenith_rad, cloud_mask) 
-        for cloud_height in cloud_heights
-    ])
 
-    potential_shadow = np.sum(potential_shadow, axis=0) > 0
-    
-    shadow = potential_shadow
-    
+    shifts = {__get_shadow_shift(cloud_height, azimuth_rad, zenith_rad) for cloud_height in cloud_heights}
+
+    shadow = np.zeros(cloud_mask.shape, dtype=bool)
+    for x_shift, y_shift in shifts:
+        or_shifted(shadow, cloud_mask, x_shift, y_shift)
+
     return shadow
 
 
+def __get_cloud_shadow_reach(meta, cloud_heights=CLOUD_HEIGHTS):
+    """
+    Furthest, in pixels along either axis, that a cloud's shadow lands from the cloud.
+    """
+
+    azimuth_rad = np.deg2rad(meta["AZIMUTH_ANGLE"] - 270)
+    zenith_rad = np.deg2rad(meta["ZENITH_ANGLE"])
+
+    shifts = [__get_shadow_shift(cloud_height, azimuth_rad, zenith_rad) for cloud_height in cloud_heights]
+    return max(max(abs(x_shift), abs(y_shift)) for x_shift, y_shift in shifts)
+
+
 ### SCL masking ###
 
 def __get_scl_bad_pixel_mask(scl):
@@ -124,69 +135,117 @@ def apply_scl_cloud_mask(stack_tif_path, meta, dst_path):
     return dst_path
 
 
-def apply_cloud_mask(stack_tif_path, meta, dst_path, model_path):
+def apply_cloud_mask(stack_tif_path, meta, dst_path, model_path, tile_size=CLOUD_MASK_TILE_SIZE, overlap=CLOUD_MASK_TILE_OVERLAP, nn_cloud_mask_path=None):
+    """
+    Masks clouds, cloud shadows and bad pixels in a stack tile by tile, reading windows from
+    stack_tif_path and writing them to dst_path, so peak memory doesn't grow with the region.
+    Pass nn_cloud_mask_path when predict_nn_cloud_masks already ran for this stack, it's removed afterwards.
+    """
 
-    with rasterio.open(stack_tif_path) as src:
-        stack_data = src.read(masked=True)
-        bbox = list(src.bounds)
+    # 1. neural network cloud mask, tiles overlap so every pixel is predicted with context around it
+    if nn_cloud_mask_path is None:
+        nn_cloud_mask_path = predict_nn_cloud_masks({stack_tif_path: stack_tif_path}, model_path, tile_size, overlap)[stack_tif_path]
 
-    if stack_data.size > 12000000:
-        stack_data = __apply_nn_cloud_mask_chunks(stack_data, meta, model_path)
-    else:
-        stack_data = __apply_nn_cloud_mask(stack_data, meta, model_path)
+    # 2. shadows and buffer, the halo covers the furthest a cloud can reach into a tile
+    halo = __get_cloud_shadow_reach(meta) + __get_buffer_reach(CLOUD_MASK_BUFFER_SIZE)
 
-    stack_data = stack_data.transpose((1, 2, 0))
-    write_array_to_tif(stack_data, dst_path, bbox, dtype=np.float32, epsg=4326, nodata=NODATA_FLOAT32)
+    masked_count, total_count = 0, 0
+    with rasterio.open(stack_tif_path) as src, rasterio.open(nn_cloud_mask_path) as nn_src:
+
+        profile = {
+            "driver": "GTiff",
+            "height": src.height,
+            "width": src.width,
+            "count": src.count - 1, # drop SCL
+            "dtype": np.float32,
+            "crs": src.crs,
+            "transform": src.transform,
+            "nodata": NODATA_FLOAT32,
+        }
+
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            for core, read in get_tile_windows(src.height, src.width, tile_size, halo):
+
+                stack_data = src.read(masked=True, window=read)
+                nn_cloud_mask = nn_src.read(1, window=read).astype(bool)
+
+                stack_data = __apply_cloud_mask_tile(stack_data, nn_cloud_mask, meta)
+
+                rows, cols = get_core_slices(core, read)
+                stack_data = stack_data[:, rows, cols]
+                dst.write(stack_data.filled(NODATA_FLOAT32), window=core)
+
+                masked_count += np.ma.getmaskarray(stack_data).sum()
+                total_count += stack_data.size
+
+    os.remove(nn_cloud_mask_path)
 
     # rgb_path = dst_path.replace('.tif', '_rgb.tif')
     # create_rgb_byte_tif_from_composite(dst_path, rgb_path, is_cog=True, use_alpha=False)
 
-    pct_masked = stack_data.mask.sum() / stack_data.mask.size
+    pct_masked = masked_count / total_count
     return pct_masked < 0.90
 
 
-def __apply_nn_cloud_mask_chunks(stack_data, meta, model_path):
+def predict_nn_cloud_masks(stack_tif_paths, model_path, tile_size=CLOUD_MASK_TILE_SIZE, overlap=CLOUD_MASK_TILE_OVERLAP, batch_size=CLOUD_MASK_BATCH_SIZE):
+    """
+    Runs the cloud model over the stacks of several scenes at once. Every stack is cut into tiles,
+    each padded up to a multiple of 32, tiles of the same shape from all scenes are batched together
+    and each prediction is written back to its scene's uint8 mask next to the stack. Returns the
+    mask paths, keyed like stack_tif_paths.
+    """
+
+    nn_cloud_mask_paths = {key: path.replace('.tif', '_nn_cloud.tif') for key, path in stack_tif_paths.items()}
 
-    dim_index = 1 if stack_data.shape[1] > stack_data.shape[2] else 2
+    with ExitStack() as stack:
 
-    dim_size = stack_data.shape[dim_index]
-    if dim_size % 2 == 1:
-        split_index = dim_size // 2 + 1
-    else:
-        split_index = dim_size // 2
+        srcs, dsts = {}, {}
+        for key, path in stack_tif_paths.items():
+            srcs[key] = src = stack.enter_context(rasterio.open(path))
+            profile = {
+                "driver": "GTiff",
+                "height": src.height,
+                "width": src.width,
+                "count": 1,
+                "dtype": np.uint8,
+                "crs": src.crs,
+                "transform": src.transform,
+            }
+            dsts[key] = stack.enter_context(rasterio.open(nn_cloud_mask_paths[key], 'w', **profile))
 
-    stack_data_1, stack_data_2 = np.split(stack_data, [split_index], axis=dim_index)
+        tiles = __get_nn_cloud_tiles(srcs, tile_size, overlap)
 
-    masked_data_1 = __apply_nn_cloud_mask(stack_data_1, meta, model_path)
-    masked_data_2 = __apply_nn_cloud_mask(stack_data_2, meta, model_path)
+        start_time, tile_count = time.time(), 0
+        for (key, core, read), logits in predict_batches(model_path, tiles, batch_size):
 
-    masked_data = np.ma.concatenate((masked_data_1, masked_data_2), axis=dim_index)
+            probabilities = sigmoid(logits[0, :, :])
+            binary_prediction = (probabilities >= 0.50).astype(np.uint8)
 
-    return masked_data
+            rows, cols = get_core_slices(core, read)
+            dsts[key].write(binary_prediction[rows, cols], indexes=1, window=core)
+            tile_count += 1
 
+    elapsed = time.time() - start_time
+    print(f'\tcloud model: {tile_count} tiles from {len(stack_tif_paths)} scenes in {elapsed:.2f} seconds, {tile_count / elapsed:.2f} tiles/s at batch size {batch_size}')
 
-def __apply_nn_cloud_mask(stack_data, meta, model_path):
+    return nn_cloud_mask_paths
+
+
+def __get_nn_cloud_tiles(srcs, tile_size, overlap):
+
+    for key, src in srcs.items():
+        image_bands = list(range(1, src.count)) # everything but SCL
+
+        for core, read in get_tile_windows(src.height, src.width, tile_size, overlap):
+            image = src.read(image_bands, masked=True, window=read)
+            image = image.filled(-1.0) # convert to ndarray and fills masked values with -1.0
+            # only as big as the UNet needs, a small scene or a thin edge tile isn't padded to a full tile
+            yield (key, core, read), pad_to_shape(image, round_up_to_multiple(image.shape[1], 32), round_up_to_multiple(image.shape[2], 32))
+
+
+def __apply_cloud_mask_tile(stack_data, nn_cloud_mask, meta):
 
     scl_data = stack_data[-1, :, :]
-        
-    image = stack_data[:-1, :, :]
-    image = image.filled(-1.0) # convert to ndarray and fills masked values with -1.0
-    saved_shape = image.shape
-
-    height_pad = 32 - (image.shape[1] % 32)
-    width_pad = 32 - (image.shape[2] % 32)
-    image = np.pad(image, ((0, 0), (0, height_pad), (0, width_pad)), mode='reflect')
-            
-    image = np.expand_dims(image, 0)
-    image = torch.tensor(image)
-        
-    model = torch.load(model_path)
-    prediction = model.predict(image)
-    
-    probabilities = torch.sigmoid(prediction).cpu().numpy()
-    probabilities = probabilities[0, 0, :, :]
-    binary_prediction = (probabilities >= 0.50).astype(bool)
-    nn_cloud_mask = binary_prediction[:saved_shape[1], :saved_shape[2]]
     
     scl_cloud_mask = __get_scl_cloud_mask(scl_data)
     cloud_mask = nn_cloud_mask | scl_cloud_mask
@@ -196,7 +255,7 @@ def __apply_nn_cloud_mask(stack_data, meta, model_path):
     cloud_shadow_mask = __get_cloud_shadow_mask(cloud_mask, meta["AZIMUTH_ANGLE"], meta["ZENITH_ANGLE"])
         
     full_mask = cloud_mask | bad_mask | cloud_shadow_mask
-    full_mask = __buffer_mask(full_mask, radius=20)
+    full_mask = __buffer_mask(full_mask, radius=CLOUD_MASK_BUFFER_SIZE)
     
     stack_data.mask = full_mask | stack_data.mask 
     stack_data = stack_data[:-1, :, :]
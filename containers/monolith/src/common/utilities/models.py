@@ -0,0 +1,284 @@
+import inspect
+import numpy as np
+import os
+import time
+
+from common.constants import MODEL_BACKEND, MODEL_PRECISION, MODEL_TORCHSCRIPT, ONNX_INTRA_OP_THREADS
+from common.utilities.profiling import get_rss_bytes
+
+
+# torch is imported where it's used, so the onnx backend can start without it
+
+MODEL_BACKENDS = ('torch', 'onnx')
+MODEL_PRECISIONS = ('fp32', 'bf16', 'int8_dynamic', 'int8_static')
+
+
+### process-wide model registry ###
+
+__models = {}
+
+# keyed like the registry, one record per loaded configuration of a model
+model_metrics = {}
+
+
+def get_model(model_path, torchscript=MODEL_TORCHSCRIPT, precision=MODEL_PRECISION, backend=MODEL_BACKEND):
+    """
+    Loads a .pth model once per process and puts it in inference mode.
+    int8 precisions quantize the model after loading, bf16 is applied as autocast in predict.
+    With torchscript=True the model is traced and frozen, falling back to eager if tracing fails.
+    The onnx backend returns an onnxruntime session for the exported model instead, and ignores
+    torchscript and precision.
+    """
+
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f'unknown model backend {backend}, expected one of {MODEL_BACKENDS}')
+    if precision not in MODEL_PRECISIONS:
+        raise ValueError(f'unknown model precision {precision}, expected one of {MODEL_PRECISIONS}')
+
+    if backend == 'onnx':
+        torchscript, precision = False, 'fp32'
+
+    key = (model_path, backend, torchscript, precision)
+    if key in __models:
+        model_metrics[key]['hits'] += 1
+        return __models[key]
+
+    start_time = time.time()
+    rss_start = get_rss_bytes()
+
+    if backend == 'onnx':
+        model = __load_onnx_session(model_path)
+        parameter_bytes = os.path.getsize(get_onnx_path(model_path))
+    else:
+        model, parameter_bytes = __load_torch_model(model_path, torchscript, precision)
+
+    load_secs = time.time() - start_time
+    model_metrics[key] = {
+        'model_path': model_path,
+        'backend': backend,
+        'hits': 0,
+        'load_secs': load_secs,
+        'parameter_bytes': parameter_bytes,
+        'precision': precision,
+        'rss_delta_bytes': get_rss_bytes() - rss_start,
+        'torchscript': type(model).__module__.startswith('torch.jit'),
+    }
+
+    print(f'loaded {model_path} ({backend}, {precision}) in {load_secs:.2f} seconds')
+
+    __models[key] = model
+    return model
+
+
+def get_model_metrics():
+    """
+    Load time, memory and cache hits of every model configuration loaded in this process, as a
+    list of records for the run report.
+    """
+
+    return [dict(metrics) for _, metrics in sorted(model_metrics.items(), key=lambda item: str(item[0]))]
+
+
+def predict(model_path, image, torchscript=MODEL_TORCHSCRIPT, precision=MODEL_PRECISION, backend=MODEL_BACKEND):
+    """
+    Forward pass on a float32 (batch, channels, height, width) array, returns the raw logits as a float32 array.
+    """
+
+    model = get_model(model_path, torchscript, precision, backend)
+    image = np.ascontiguousarray(image, dtype=np.float32)
+
+    if backend == 'onnx':
+        return model.run(None, {model.get_inputs()[0].name: image})[0]
+
+    import torch
+
+    with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=(precision == 'bf16')):
+        prediction = model(torch.from_numpy(image))
+
+    return prediction.float().numpy()
+
+
+def predict_batches(model_path, tiles, batch_size, torchscript=MODEL_TORCHSCRIPT, precision=MODEL_PRECISION, backend=MODEL_BACKEND):
+    """
+    Runs (key, image) pairs of (channels, height, width) tiles through the model batch_size at a
+    time and yields (key, logits) pairs. Tiles are batched with others of the same shape, so
+    results come back in order within a shape but not across shapes.
+    """
+
+    batches = {}
+    for key, image in tiles:
+        batch = batches.setdefault(image.shape, [])
+        batch.append((key, image))
+        if len(batch) == batch_size:
+            yield from __predict_batch(model_path, batch, torchscript, precision, backend)
+            del batches[image.shape]
+
+    for batch in batches.values():
+        yield from __predict_batch(model_path, batch, torchscript, precision, backend)
+
+
+def __predict_batch(model_path, batch, torchscript, precision, backend):
+
+    keys = [key for key, _ in batch]
+    logits = predict(model_path, np.stack([image for _, image in batch]), torchscript, precision, backend)
+    return zip(keys, logits)
+
+
+def sigmoid(logits):
+    return 1 / (1 + np.exp(-logits))
+
+
+### torch backend ###
+
+def __load_torch_model(model_path, torchscript, precision):
+
+    import torch
+
+    # the .pth files are whole pickled modules, not state dicts
+    model = torch.load(model_path, map_location='cpu', weights_only=False)
+    model.eval()
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+
+    parameter_bytes = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+    if precision == 'int8_dynamic':
+        # dynamic quantization only covers linear and recurrent layers
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif precision == 'int8_static':
+        model = __load_static_int8(model, model_path)
+
+    if torchscript:
+        model = __to_torchscript(model, model_path)
+
+    return model, parameter_bytes
+
+
+### static int8 quantization ###
+
+def get_static_int8_path(model_path):
+    return model_path.replace('.pth', '_int8_static.pth')
+
+
+def calibrate_static_int8(model_path, images):
+    """
+    Quantizes a model to int8 with activation ranges observed on float32 (channels, height, width)
+    calibration images and saves the quantized weights next to it for precision='int8_static'.
+    """
+
+    import torch
+
+    model = torch.load(model_path, map_location='cpu', weights_only=False)
+    model.eval()
+
+    quantized = __quantize_static(model, images)
+
+    static_int8_path = get_static_int8_path(model_path)
+    torch.save(quantized.state_dict(), static_int8_path)
+    return static_int8_path
+
+
+def __quantize_static(model, images):
+
+    import torch
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    example = torch.from_numpy(np.ascontiguousarray(images[:1], dtype=np.float32))
+    prepared = prepare_fx(model, qconfig_mapping, (example,))
+
+    with torch.no_grad():
+        for image in images:
+            prepared(torch.from_numpy(np.ascontiguousarray(image[None], dtype=np.float32)))
+
+    return convert_fx(prepared)
+
+
+def __load_static_int8(model, model_path):
+
+    static_int8_path = get_static_int8_path(model_path)
+    if not os.path.exists(static_int8_path):
+        print(f'no int8 calibration for {model_path} at {static_int8_path}, using fp32 model')
+        return model
+
+    import torch
+
+    # quantize with placeholder ranges to get the module structure, then load the calibrated ones
+    in_channels = __get_in_channels(model)
+    quantized = __quantize_static(model, np.zeros((1, in_channels, 64, 64), dtype=np.float32))
+    quantized.load_state_dict(torch.load(static_int8_path, map_location='cpu'))
+    return quantized
+
+
+def __get_in_channels(model):
+
+    import torch
+
+    return next(m for m in model.modules() if isinstance(m, torch.nn.Conv2d)).in_channels
+
+
+def __to_torchscript(model, model_path):
+
+    import torch
+
+    try:
+        example = torch.zeros((1, __get_in_channels(model), 64, 64), dtype=torch.float32)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        return torch.jit.optimize_for_inference(traced)
+    except Exception as e:
+        print(f'torchscript conversion failed for {model_path}, using eager model: {e}')
+        return model
+
+
+### onnx backend ###
+
+def get_onnx_path(model_path):
+    return model_path.replace('.pth', '.onnx')
+
+
+def export_onnx(model_path, opset_version=17):
+    """
+    Exports a .pth model to ONNX next to it, with batch, height and width left dynamic.
+    """
+
+    import torch
+
+    model, _ = __load_torch_model(model_path, torchscript=False, precision='fp32')
+    example = torch.zeros((1, __get_in_channels(model), 64, 64), dtype=torch.float32)
+
+    onnx_path = get_onnx_path(model_path)
+    dynamic_axes = {'image': {0: 'batch', 2: 'height', 3: 'width'}, 'logits': {0: 'batch', 2: 'height', 3: 'width'}}
+
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False # newer torch defaults to the dynamo exporter, keep the traced one
+
+    torch.onnx.export(
+        model, example, onnx_path,
+        input_names=['image'],
+        output_names=['logits'],
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+        **kwargs
+    )
+
+    print(f'exported {model_path} to {onnx_path}')
+    return onnx_path
+
+
+def __load_onnx_session(model_path, intra_op_threads=ONNX_INTRA_OP_THREADS):
+
+    import onnxruntime
+
+    onnx_path = get_onnx_path(model_path)
+    if not os.path.exists(onnx_path):
+        # normally done when the image is built, this needs torch
+        export_onnx(model_path)
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads # 0 lets onnxruntime use every core
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    return onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
@@ -0,0 +1,82 @@
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+
+def dilate(mask, footprint):
+    """
+    Binary dilation of mask by footprint, equal to maximum_filter(mask, footprint=footprint,
+    mode='constant', cval=0). The largest disk inside the footprint comes from a Euclidean
+    distance transform threshold in linear time, the few footprint offsets outside it are ORed
+    in as shifted copies, so round footprints cost about the same at any radius.
+    """
+
+    offsets = __get_offsets(footprint)
+    disk_radius_sq = __get_inner_disk_radius_sq(offsets)
+
+    dilated = np.zeros(mask.shape, dtype=bool)
+    if not mask.any():
+        return dilated
+
+    if disk_radius_sq >= 0:
+        # squared distances are integers, so any threshold between r^2 and r^2 + 1 is exact
+        distances = distance_transform_edt(~mask)
+        dilated = distances <= np.sqrt(disk_radius_sq + 0.5)
+
+    for y_shift, x_shift in offsets:
+        if y_shift ** 2 + x_shift ** 2 > disk_radius_sq:
+            or_shifted(dilated, mask, x_shift, y_shift)
+
+    return dilated
+
+
+def get_reach(footprint):
+    """
+    Furthest, in pixels along either axis, that dilation by footprint spreads a pixel. Tiles need a halo this wide.
+    """
+
+    return int(np.abs(__get_offsets(footprint)).max())
+
+
+def or_shifted(dst, src, x_shift, y_shift):
+    """
+    dst[i + y_shift, j + x_shift] |= src[i, j] in place, pixels shifted off the edge are dropped.
+    """
+
+    height, width = src.shape
+    if abs(y_shift) >= height or abs(x_shift) >= width:
+        return
+
+    dst_rows, src_rows = __get_shifted_slices(y_shift, height)
+    dst_cols, src_cols = __get_shifted_slices(x_shift, width)
+
+    np.logical_or(dst[dst_rows, dst_cols], src[src_rows, src_cols], out=dst[dst_rows, dst_cols])
+
+
+def __get_shifted_slices(shift, size):
+
+    if shift >= 0:
+        return slice(shift, size), slice(0, size - shift)
+    return slice(0, size + shift), slice(-shift, size)
+
+
+def __get_offsets(footprint):
+
+    # scipy filters centre the footprint on size // 2, so even sizes reach one further up and left.
+    # a pixel at i lights up i - (k - centre) for every footprint position k
+    rows, cols = np.nonzero(footprint)
+    y_offsets = footprint.shape[0] // 2 - rows
+    x_offsets = footprint.shape[1] // 2 - cols
+
+    return np.stack([y_offsets, x_offsets], axis=1)
+
+
+def __get_inner_disk_radius_sq(offsets):
+
+    # the largest r^2 such that every offset with y^2 + x^2 <= r^2 is in the footprint, -1 if none is
+    reach = int(np.abs(offsets).max()) + 1
+    y, x = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+
+    inside = np.zeros(y.shape, dtype=bool)
+    inside[offsets[:, 0] + reach, offsets[:, 1] + reach] = True
+
+    return int((y[~inside] ** 2 + x[~inside] ** 2).min()) - 1
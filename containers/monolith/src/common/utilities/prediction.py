@@ -1,57 +1,92 @@
 import numpy as np
 import rasterio
-import torch
 
 
-from common.constants import LANDCOVER_COLORS
-from common.utilities.imagery import write_array_to_tif
+from common.constants import LANDCOVER_COLORS, LANDCOVER_TILE_OVERLAP, LANDCOVER_TILE_SIZE, NODATA_BYTE
+from common.utilities.models import predict, sigmoid
+from common.utilities.tiling import get_core_slices, get_tile_windows, pad_to_multiple
 
 
-    
-def apply_landcover_classification(tif_path, dst_path, landcover_model_path):
+
+def apply_landcover_classification(tif_path, dst_path, landcover_model_path, tile_size=LANDCOVER_TILE_SIZE, overlap=LANDCOVER_TILE_OVERLAP):
+    """
+    Classifies a composite in overlapping windows, writing each window's classes to dst_path as it goes.
+    Returns pixel counts per class value, nodata included, for calculate_landcover_statistics.
+    With tile_size=None the composite is classified in a single pass.
+    """
+
+    class_counts = np.zeros(256, dtype=np.int64)
 
     with rasterio.open(tif_path) as src:
-        data = src.read(masked=True)
-        saved_mask = data.mask
-        saved_shape = data.shape
-        data = data.filled(-1.0)
-        bbox = list(src.bounds)
 
-    height_pad = 32 - (data.shape[1] % 32)
-    width_pad = 32 - (data.shape[2] % 32)
-    padded_data = np.pad(data, ((0, 0), (0, height_pad), (0, width_pad)), mode='reflect')
+        profile = {
+            "driver": "GTiff",
+            "height": src.height,
+            "width": src.width,
+            "count": 1,
+            "dtype": np.uint8,
+            "crs": src.crs,
+            "transform": src.transform,
+            "nodata": NODATA_BYTE,
+        }
+
+        if tile_size is None:
+            tile_size, overlap = max(src.height, src.width), 0
+
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            for core, read in get_tile_windows(src.height, src.width, tile_size, overlap):
+
+                data = src.read(masked=True, window=read)
+                prediction = __predict_landcover_tile(data, landcover_model_path)
+
+                rows, cols = get_core_slices(core, read)
+                prediction = prediction[rows, cols]
+                dst.write(prediction, indexes=1, window=core)
+
+                class_counts += np.bincount(prediction.ravel(), minlength=256)
+
+    return class_counts
+
+
+def __predict_landcover_tile(data, landcover_model_path):
+
+    saved_mask = np.ma.getmaskarray(data)[0, :, :]
+    saved_shape = data.shape
+    data = data.filled(-1.0)
+
+    image = np.expand_dims(pad_to_multiple(data, 32), 0)
 
-    image = np.expand_dims(padded_data, 0)     
-    image = torch.tensor(image)
+    prediction = predict(landcover_model_path, image)
 
-    model = torch.load(landcover_model_path)
-    prediction = model.predict(image)
+    probabilities = sigmoid(prediction)
+    prediction = np.argmax(probabilities, axis=1)
 
-    probabilities = torch.sigmoid(prediction)
-    prediction = torch.argmax(probabilities, dim=1)
+    prediction = prediction.squeeze(0)
+    prediction = prediction[:saved_shape[1], :saved_shape[2]].astype(np.uint8)
 
-    prediction = (prediction.squeeze().cpu().numpy().round())
-    prediction = prediction[:saved_shape[1], :saved_shape[2]]
+    prediction[saved_mask | (prediction == 0)] = NODATA_BYTE
+    return prediction
 
-    prediction = np.ma.array(prediction, mask=saved_mask[0, :, :])
-    prediction.mask |= (prediction == 0)
-    
-    write_array_to_tif(prediction, dst_path, bbox, dtype=np.uint8, epsg=4326, nodata=255)
 
+def calculate_landcover_statistics(landcover_path, class_counts=None):
 
-def calculate_landcover_statistics(landcover_path):
+    if class_counts is None:
+        class_counts = np.zeros(256, dtype=np.int64)
+        with rasterio.open(landcover_path) as src:
+            for _, window in src.block_windows(1):
+                class_counts += np.bincount(src.read(1, window=window).ravel(), minlength=256)
 
-    with rasterio.open(landcover_path) as src:
-        prediction = src.read(masked=True)
+    total_count = class_counts.sum()
+    valid_count = total_count - class_counts[NODATA_BYTE]
 
     statistics = {}
     for idx, info in LANDCOVER_COLORS.items():
         name = info[1]
-        class_mask = (prediction == idx)
+        class_count = class_counts[idx]
         statistics[name] = {
-            "area_ha": np.sum(class_mask) * 0.01, # 100 m2 = 0.01 ha
-            "percent_total": np.sum(class_mask) / prediction.data.size,
-            "percent_masked": np.sum(class_mask) / prediction.count()   
+            "area_ha": class_count * 0.01, # 100 m2 = 0.01 ha
+            "percent_total": class_count / total_count,
+            "percent_masked": class_count / valid_count
         }
 
     return statistics
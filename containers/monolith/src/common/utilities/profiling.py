@@ -0,0 +1,307 @@
+from contextlib import ExitStack, contextmanager
+from datetime import datetime as dt
+import json
+import os
+import rasterio
+import resource
+import sentry_sdk
+import threading
+import time
+import tracemalloc
+
+from common.constants import PROFILE_RSS_INTERVAL_SECS, PROFILE_TRACEMALLOC
+
+
+def get_rss_bytes():
+    """
+    Current resident set size of this process and every process descended from it, so process
+    pool workers count towards the memory a task needs. Pages a forked child still shares with
+    its parent are counted in both.
+    """
+
+    if not os.path.exists('/proc/self/statm'):
+        # not Linux, fall back to the peak
+        return get_peak_rss_bytes()
+
+    pages = 0
+    for pid in ['self'] + __get_descendant_pids():
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                pages += int(f.read().split()[1])
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def track_peak_rss(interval=0.01):
+    """
+    Samples the RSS of this process and its descendants on a background thread while the block
+    runs. Yields a dict whose 'peak_rss_bytes' holds the highest sample once the block exits,
+    unlike ru_maxrss it isn't the peak of the whole process so far.
+    """
+
+    result = {'peak_rss_bytes': get_rss_bytes()}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            result['peak_rss_bytes'] = max(result['peak_rss_bytes'], get_rss_bytes())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+
+    try:
+        yield result
+    finally:
+        stop.set()
+        thread.join()
+        result['peak_rss_bytes'] = max(result['peak_rss_bytes'], get_rss_bytes())
+
+
+def get_io_bytes():
+    """
+    (read, written) bytes of this process through read and write calls, including sockets, from
+    /proc/self/io. (0, 0) where that isn't available.
+    """
+
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (FileNotFoundError, PermissionError):
+        return 0, 0
+
+
+def get_cpu_secs():
+    """
+    User and system CPU time of this process and every process descended from it, finished or
+    not. Pool workers started by a fork server descend from it through the server, which is a
+    child of this process, so stages that run a process pool count their workers.
+    """
+
+    times = os.times()
+    secs = times.user + times.system + times.children_user + times.children_system
+
+    # live descendants aren't in os.times yet, the ones they reaped are in their own children fields
+    for pid in __get_descendant_pids():
+        fields = __read_proc_stat(pid)
+        if fields is not None:
+            secs += sum(int(field) for field in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+
+    return secs
+
+
+def __read_proc_stat(pid):
+
+    # the fields after the parenthesised command name, which may contain spaces, starting at state
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()
+    except (FileNotFoundError, ProcessLookupError, IndexError):
+        return None
+
+
+def __get_descendant_pids():
+
+    if not os.path.exists('/proc/self/stat'):
+        return []
+
+    children = {}
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            fields = __read_proc_stat(name)
+            if fields is not None:
+                children.setdefault(int(fields[1]), []).append(int(name))
+
+    descendants, parents = [], [os.getpid()]
+    while parents:
+        pids = children.get(parents.pop(), [])
+        descendants += pids
+        parents += pids
+
+    return descendants
+
+
+def get_raster_pixels(*paths):
+    """
+    Total width x height of the rasters at paths.
+    """
+
+    pixels = 0
+    for path in paths:
+        with rasterio.open(path) as src:
+            pixels += src.width * src.height
+
+    return pixels
+
+
+@contextmanager
+def track_peak_traced_bytes():
+    """
+    Traces Python allocations, numpy arrays included, while the block runs. Yields a dict whose
+    'peak_traced_bytes' holds the highest traced total once the block exits. Allocations made by
+    GDAL or torch aren't traced, RSS covers those.
+    """
+
+    result = {'peak_traced_bytes': None}
+
+    # python 3.8 can't reset the peak, so trace from scratch unless something else is tracing
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+
+    try:
+        yield result
+    finally:
+        result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1] - start_bytes
+        if started:
+            tracemalloc.stop()
+
+
+class RunReport:
+    """
+    Wall time, CPU time, bytes read and written, pixel counts and peak memory for each stage of
+    a run. Each stage is also a Sentry span under the current transaction.
+    """
+
+    def __init__(self, task_uid=None, task_type=None, trace_allocations=PROFILE_TRACEMALLOC):
+
+        self.task_uid = task_uid
+        self.task_type = task_type
+        self.trace_allocations = trace_allocations
+        self.start_time = time.time()
+        self.stages = []
+        self.context = {}
+
+    def set_context(self, **context):
+        """
+        Records what the run processed, e.g. area_km2 and scene_count, to relate memory to.
+        """
+
+        self.context.update(context)
+
+    @contextmanager
+    def concurrent_stages(self):
+        """
+        Marks a block whose stages overlap. Allocation tracing is process wide and started per
+        stage, so it is switched off for the block, those stages' peak_traced_bytes are None
+        and the report's context says so.
+        """
+
+        trace_allocations = self.trace_allocations
+        if trace_allocations:
+            self.trace_allocations = False
+            self.set_context(allocation_tracing='off for concurrent stages')
+
+        try:
+            yield
+        finally:
+            self.trace_allocations = trace_allocations
+
+    @contextmanager
+    def stage(self, name, pixels=None):
+        """
+        Measures the block as stage name. Yields the stage's record, so the block can set
+        'pixels' once it knows how much it processed. CPU, I/O and RSS are measured for the whole
+        process, so stages run concurrently by dag.run_stages also count each other's work.
+        """
+
+        record = {'name': name, 'start_secs': round(time.time() - self.start_time, 3), 'pixels': pixels, 'status': 'ok'}
+
+        read_bytes, write_bytes = get_io_bytes()
+        cpu_secs = get_cpu_secs()
+        record['start_rss_bytes'] = get_rss_bytes()
+        start_time = time.time()
+
+        with sentry_sdk.start_span(op='stage', description=name) as span, ExitStack() as samplers:
+            rss = samplers.enter_context(track_peak_rss(PROFILE_RSS_INTERVAL_SECS))
+            traced = samplers.enter_context(track_peak_traced_bytes()) if self.trace_allocations else {}
+
+            try:
+                yield record
+            except BaseException:
+                record['status'] = 'error'
+                span.set_status('internal_error')
+                raise
+            finally:
+                end_read_bytes, end_write_bytes = get_io_bytes()
+                record['wall_secs'] = round(time.time() - start_time, 3)
+                record['cpu_secs'] = round(get_cpu_secs() - cpu_secs, 3)
+                record['read_bytes'] = end_read_bytes - read_bytes
+                record['write_bytes'] = end_write_bytes - write_bytes
+
+                samplers.close()
+                record['peak_rss_bytes'] = rss['peak_rss_bytes']
+                record['peak_traced_bytes'] = traced.get('peak_traced_bytes')
+
+                for key, value in record.items():
+                    span.set_data(key, value)
+                self.stages.append(record)
+
+                print(f'stage {name}: {record["wall_secs"]:.2f} s wall, {record["cpu_secs"]:.2f} s cpu, '
+                      f'{record["read_bytes"] / 1e6:.1f} MB read, {record["write_bytes"] / 1e6:.1f} MB written, '
+                      f'{record["peak_rss_bytes"] / 1e6:.0f} MB peak RSS')
+
+    def get_memory_summary(self):
+        """
+        Which stage bounds the run's peak RSS, and the peak per km2 and per scene where the
+        context has area_km2 and scene_count.
+        """
+
+        if not self.stages:
+            return {}
+
+        bounding = max(self.stages, key=lambda record: record['peak_rss_bytes'])
+        summary = {
+            'peak_rss_bytes': bounding['peak_rss_bytes'],
+            'peak_rss_stage': bounding['name'],
+            # how much the bounding stage added on top of what was resident when it started
+            'peak_rss_stage_growth_bytes': bounding['peak_rss_bytes'] - bounding['start_rss_bytes'],
+            'stages_by_peak_rss': [record['name'] for record in sorted(self.stages, key=lambda record: -record['peak_rss_bytes'])],
+        }
+
+        if self.context.get('area_km2'):
+            summary['peak_rss_bytes_per_km2'] = round(bounding['peak_rss_bytes'] / self.context['area_km2'])
+        if self.context.get('scene_count'):
+            summary['peak_rss_bytes_per_scene'] = round(bounding['peak_rss_bytes'] / self.context['scene_count'])
+
+        return summary
+
+    def get_summary(self):
+
+        lines = []
+        for record in self.stages:
+            lines.append(f'{record["name"]}: {record["wall_secs"]:.1f} s, {record["peak_rss_bytes"] / 1e6:.0f} MB peak RSS')
+
+        memory = self.get_memory_summary()
+        if memory:
+            lines.append(f'memory bound by {memory["peak_rss_stage"]} at {memory["peak_rss_bytes"] / 1e6:.0f} MB')
+        return '\n'.join(lines)
+
+    def save(self, dst_path):
+        """
+        Writes the report as JSON and returns dst_path.
+        """
+
+        report = {
+            'task_uid': self.task_uid,
+            'task_type': self.task_type,
+            'started': dt.utcfromtimestamp(self.start_time).isoformat() + 'Z',
+            'wall_secs': round(time.time() - self.start_time, 3),
+            'context': self.context,
+            'memory': self.get_memory_summary(),
+            'stages': self.stages,
+        }
+
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        with open(dst_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        return dst_path
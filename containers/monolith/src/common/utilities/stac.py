@@ -0,0 +1,181 @@
+from botocore.exceptions import BotoCoreError, ClientError
+import hashlib
+import json
+import os
+from pystac import ItemCollection
+from pystac_client import Client
+import time
+
+from common.aws import s3 as s3_utils
+from common.constants import STAC_API_URL, STAC_CACHE_DIR, STAC_CACHE_S3_PREFIX, STAC_CACHE_TTL_SECS
+
+
+# set to share cached searches between tasks, each Fargate task starts with an empty /tmp
+STAC_CACHE_S3_BUCKET = os.environ.get('STAC_CACHE_S3_BUCKET')
+
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    's3_hits': 0,
+    'evictions': 0,
+}
+
+
+### catalog client ###
+
+__catalog_client = None
+
+
+def get_catalog_client():
+    """
+    One catalog client per process, opening it fetches the landing page.
+    """
+
+    global __catalog_client
+    if __catalog_client is None:
+        __catalog_client = Client.open(STAC_API_URL)
+    return __catalog_client
+
+
+def set_catalog_client(client):
+    """
+    Swap the catalog client, for example for a recorded stand-in when testing offline.
+    """
+
+    global __catalog_client
+    __catalog_client = client
+
+
+### cached search ###
+
+def get_search_cache_key(bbox, datetime, collections, query=None, sortby=None):
+
+    params = {
+        'bbox': [round(float(c), 5) for c in bbox], # about 1 meter
+        'collections': sorted(collections),
+        'datetime': datetime,
+        'query': query,
+        'sortby': sortby,
+    }
+
+    params_json = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(params_json.encode('utf-8')).hexdigest()
+
+
+def search_items(bbox, datetime, collections, query=None, sortby=None, ttl=STAC_CACHE_TTL_SECS):
+    """
+    Searches the catalog and returns a list of items, served from the local cache,
+    then the optional S3 tier, before the catalog is paged.
+    """
+
+    key = get_search_cache_key(bbox, datetime, collections, query, sortby)
+    cache_path = f'{STAC_CACHE_DIR}/{key}.json'
+
+    items = __read_local(cache_path, ttl)
+    if items is None and STAC_CACHE_S3_BUCKET is not None:
+        items = __read_s3(key, cache_path, ttl)
+        if items is not None:
+            cache_stats['s3_hits'] += 1
+
+    if items is not None:
+        cache_stats['hits'] += 1
+        print(f'stac cache hit: {key}')
+        return items
+
+    cache_stats['misses'] += 1
+    print(f'stac cache miss: {key}')
+
+    search = get_catalog_client().search(
+        bbox=bbox,
+        collections=collections,
+        datetime=datetime,
+        sortby=sortby,
+        query=query,
+    )
+    items = list(search.items())
+
+    # don't pin an empty result, new scenes may show up before the TTL runs out
+    if len(items) > 0:
+        __write(key, cache_path, items)
+        evict_expired(ttl)
+
+    return items
+
+
+def evict_expired(ttl=STAC_CACHE_TTL_SECS):
+
+    if not os.path.exists(STAC_CACHE_DIR):
+        return
+
+    for file_name in os.listdir(STAC_CACHE_DIR):
+        path = f'{STAC_CACHE_DIR}/{file_name}'
+        if file_name.endswith('.json') and time.time() - os.path.getmtime(path) > ttl:
+            os.remove(path)
+            cache_stats['evictions'] += 1
+
+
+def get_cache_stats():
+    """
+    Search cache hits, misses and evictions in this process, for the run report.
+    """
+
+    return dict(cache_stats)
+
+
+def __read_local(cache_path, ttl):
+
+    if not os.path.exists(cache_path):
+        return None
+
+    if time.time() - os.path.getmtime(cache_path) > ttl:
+        os.remove(cache_path)
+        cache_stats['evictions'] += 1
+        return None
+
+    return list(ItemCollection.from_file(cache_path))
+
+
+def __read_s3(key, cache_path, ttl):
+
+    # the cache is best effort, S3 failing falls through to the catalog
+    try:
+        result = s3_utils.get_item(STAC_CACHE_S3_BUCKET, f'{STAC_CACHE_S3_PREFIX}/{key}.json')
+    except (BotoCoreError, ClientError) as e:
+        print(f'stac cache s3 read failed: {e}')
+        return None
+
+    if result is None:
+        return None
+
+    body, last_modified = result
+    age = time.time() - last_modified.timestamp()
+    if age > ttl:
+        return None
+
+    # keep the S3 object's age so the local copy expires at the same time
+    __write_local(cache_path, body)
+    os.utime(cache_path, (time.time() - age, time.time() - age))
+
+    return list(ItemCollection.from_file(cache_path))
+
+
+def __write(key, cache_path, items):
+
+    body = json.dumps(ItemCollection(items=items).to_dict()).encode('utf-8')
+    __write_local(cache_path, body)
+
+    if STAC_CACHE_S3_BUCKET is not None:
+        try:
+            s3_utils.put_item_body(body, STAC_CACHE_S3_BUCKET, f'{STAC_CACHE_S3_PREFIX}/{key}.json')
+        except (BotoCoreError, ClientError) as e:
+            print(f'stac cache s3 write failed: {e}')
+
+
+def __write_local(cache_path, body):
+
+    os.makedirs(STAC_CACHE_DIR, exist_ok=True)
+
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(body)
+    os.replace(temp_path, cache_path)
@@ -0,0 +1,370 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import math
+import multiprocessing
+import numpy as np
+import os
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, transform_bounds
+from rasterio.windows import Window
+import tempfile
+import time
+import warnings
+
+from common.constants import MAP_TILES_CHUNK_LEVELS, MAP_TILES_DEDUPLICATE, MAP_TILES_MIN_PIXELS, PROCESS_POOL_START_METHOD
+
+
+TILE_SIZE = 256
+
+TILES_MANIFEST_NAME = 'manifest.json'
+
+WEB_MERCATOR = CRS.from_epsg(3857)
+WEB_MERCATOR_ORIGIN = 20037508.342789244 # half the width of the world in EPSG:3857 metres
+WEB_MERCATOR_MAX_LAT = 85.0511287798066
+
+
+def create_map_tiles(file_path, tiles_dir=None, min_zoom=None, max_zoom=None, max_workers=None, write_tile=None, deduplicate=MAP_TILES_DEDUPLICATE):
+    """
+    Renders {z}/{x}/{y}.png tiles, y counted from the south like gdal2tiles, straight from a byte
+    RGB or RGBA tif. The deepest zoom is cut in chunks of tiles, each warped from its own window of
+    the source in a process pool, and every lower zoom is averaged down from the one above, so the
+    source is read once. Zooms not given are picked from the source resolution and extent.
+
+    Each tile is handed to write_tile(tile_path, png) as soon as it is rendered, which by default
+    writes it under tiles_dir. Fully transparent tiles are skipped. With deduplicate a tile whose
+    bytes match an earlier one is only listed in manifest.json's aliases as a copy of it, so plain
+    XYZ clients that don't read the manifest would miss it.
+    """
+
+    if write_tile is None:
+        write_tile = lambda tile_path, png: __write_file(tiles_dir, tile_path, png)
+
+    print(f'generating tiles from {file_path}')
+    start_time = time.time()
+
+    with rasterio.open(file_path) as src:
+        bounds = __get_mercator_bounds(src)
+        default_transform, _, _ = calculate_default_transform(src.crs, WEB_MERCATOR, src.width, src.height, *src.bounds)
+
+    native_zoom, fit_zoom = get_zoom_range(bounds, default_transform.a)
+    max_zoom = native_zoom if max_zoom is None else min(max_zoom, native_zoom)
+    min_zoom = min(fit_zoom if min_zoom is None else min_zoom, max_zoom)
+
+    # chunks are tiles of chunk_zoom, each covers a block of max_zoom tiles rendered together
+    chunk_zoom = max(min_zoom, max_zoom - MAP_TILES_CHUNK_LEVELS)
+    chunk_x0, chunk_y0, chunk_x1, chunk_y1 = get_tile_range(bounds, chunk_zoom)
+    chunks = [(x, y) for y in range(chunk_y0, chunk_y1 + 1) for x in range(chunk_x0, chunk_x1 + 1)]
+
+    print(f'\tzooms {min_zoom} to {max_zoom}, {len(chunks)} chunks of zoom {chunk_zoom}')
+
+    tiles, tile_count = {}, 0
+    publisher = __TilePublisher(write_tile, deduplicate)
+
+    # only a few chunks are in flight, so a slow write_tile holds the workers back instead of
+    # rendered tiles piling up in memory
+    max_pending = 2 * (max_workers or os.cpu_count())
+    render_args = (file_path, bounds, min_zoom, max_zoom, chunk_zoom)
+    mp_context = multiprocessing.get_context(PROCESS_POOL_START_METHOD)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=__open_tile_source, initargs=render_args) as executor:
+        pending = deque()
+        for i, chunk in enumerate(chunks):
+            pending.append((chunk, executor.submit(__render_chunk, chunk)))
+
+            while pending and (len(pending) >= max_pending or i == len(chunks) - 1):
+                done_chunk, future = pending.popleft()
+                tiles[done_chunk], chunk_tile_count, chunk_pngs = future.result()
+                tile_count += chunk_tile_count
+                for tile_path, png in chunk_pngs:
+                    publisher.publish(tile_path, png)
+
+    # below the chunks there are few enough tiles to build them here
+    for zoom in range(chunk_zoom - 1, min_zoom - 1, -1):
+        tiles = __get_parent_tiles(tiles)
+        for (x, y), tile in tiles.items():
+            encoded = __encode_tile(tile, zoom, x, y)
+            if encoded is not None:
+                publisher.publish(*encoded)
+        tile_count += len(tiles)
+
+    if deduplicate:
+        manifest = {
+            'scheme': 'tms',
+            'tile_size': TILE_SIZE,
+            'min_zoom': min_zoom,
+            'max_zoom': max_zoom,
+            'aliases': dict(sorted(publisher.aliases.items())),
+        }
+        write_tile(TILES_MANIFEST_NAME, json.dumps(manifest).encode())
+
+    elapsed = time.time() - start_time
+    print(f'\t{tile_count} tiles in {elapsed:.1f} s, {tile_count / max(elapsed, 1e-6):.0f} tiles/s')
+    print(f'\t{tile_count - publisher.published_count - len(publisher.aliases)} transparent tiles skipped, '
+          f'{len(publisher.aliases)} duplicates aliased, {publisher.published_count} tiles written')
+
+    return min_zoom, max_zoom
+
+
+def create_map_tiles_archive(file_path, dst_path, **tile_options):
+    """
+    Renders the same pyramid as create_map_tiles into a single PMTiles archive at dst_path, which
+    clients read tiles from with HTTP range requests. Tiles are spooled to a temporary file and
+    written in tile id order, so the archive is clustered. Identical tiles are stored once by the
+    PMTiles writer itself. Needs the optional pmtiles package.
+    """
+
+    from pmtiles.tile import Compression, TileType, zxy_to_tileid
+    from pmtiles.writer import Writer
+
+    entries = []
+    with tempfile.TemporaryFile() as spool:
+
+        def spool_tile(tile_path, png):
+            zoom, x, y = __parse_tile_path(tile_path)
+            entries.append((zxy_to_tileid(zoom, x, y), spool.tell(), len(png)))
+            spool.write(png)
+
+        min_zoom, max_zoom = create_map_tiles(file_path, write_tile=spool_tile, deduplicate=False, **tile_options)
+
+        with rasterio.open(file_path) as src:
+            lon_min, lat_min, lon_max, lat_max = transform_bounds(src.crs, 'EPSG:4326', *src.bounds, densify_pts=21)
+
+        with open(dst_path, 'wb') as f:
+            writer = Writer(f)
+            for tile_id, offset, length in sorted(entries):
+                spool.seek(offset)
+                writer.write_tile(tile_id, spool.read(length))
+
+            header = {
+                'tile_type': TileType.PNG,
+                'tile_compression': Compression.NONE,
+                'min_lon_e7': int(lon_min * 1e7),
+                'min_lat_e7': int(lat_min * 1e7),
+                'max_lon_e7': int(lon_max * 1e7),
+                'max_lat_e7': int(lat_max * 1e7),
+                'center_zoom': min_zoom,
+                'center_lon_e7': int((lon_min + lon_max) / 2 * 1e7),
+                'center_lat_e7': int((lat_min + lat_max) / 2 * 1e7),
+            }
+            writer.finalize(header, {'name': os.path.basename(dst_path), 'format': 'png', 'minzoom': min_zoom, 'maxzoom': max_zoom})
+
+    print(f'\t{len(entries)} tiles archived to {dst_path}, {os.path.getsize(dst_path) / 1e6:.1f} MB')
+
+    return dst_path
+
+
+def get_zoom_range(bounds, res):
+    """
+    (native_zoom, fit_zoom) for EPSG:3857 bounds at res metres per pixel. native_zoom is the first
+    zoom whose pixels are no bigger than the source's, fit_zoom the first zoom at which the bounds
+    are MAP_TILES_MIN_PIXELS across.
+    """
+
+    world_size = 2 * WEB_MERCATOR_ORIGIN
+    native_zoom = max(0, math.ceil(math.log2(world_size / (TILE_SIZE * res))))
+
+    extent = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+    fit_zoom = max(0, math.ceil(math.log2(MAP_TILES_MIN_PIXELS * world_size / (TILE_SIZE * extent))))
+
+    return native_zoom, min(fit_zoom, native_zoom)
+
+
+def get_tile_range(bounds, zoom):
+    """
+    (x0, y0, x1, y1) inclusive XYZ tile indices, y counted from the north, covering EPSG:3857 bounds.
+    """
+
+    tile_extent = 2 * WEB_MERCATOR_ORIGIN / 2 ** zoom
+    last = 2 ** zoom - 1
+
+    x0 = math.floor((bounds[0] + WEB_MERCATOR_ORIGIN) / tile_extent)
+    x1 = math.ceil((bounds[2] + WEB_MERCATOR_ORIGIN) / tile_extent) - 1
+    y0 = math.floor((WEB_MERCATOR_ORIGIN - bounds[3]) / tile_extent)
+    y1 = math.ceil((WEB_MERCATOR_ORIGIN - bounds[1]) / tile_extent) - 1
+
+    return max(x0, 0), max(y0, 0), min(x1, last), min(y1, last)
+
+
+def __get_mercator_bounds(src):
+
+    lon_min, lat_min, lon_max, lat_max = transform_bounds(src.crs, 'EPSG:4326', *src.bounds, densify_pts=21)
+    lat_min = max(lat_min, -WEB_MERCATOR_MAX_LAT)
+    lat_max = min(lat_max, WEB_MERCATOR_MAX_LAT)
+
+    return transform_bounds('EPSG:4326', WEB_MERCATOR, lon_min, lat_min, lon_max, lat_max)
+
+
+__tile_source = {}
+
+
+def __open_tile_source(file_path, bounds, min_zoom, max_zoom, chunk_zoom):
+
+    # runs once in every worker, which warps all of its chunks from one VRT over the max_zoom tiles.
+    # max_zoom pixels are at most the size of the source's, so nearest is what the old full warp
+    # used and costs a fifth of average, the zooms below are averaged from it
+    x0, y0, x1, y1 = get_tile_range(bounds, max_zoom)
+    tile_extent = 2 * WEB_MERCATOR_ORIGIN / 2 ** max_zoom
+
+    transform = from_origin(
+        x0 * tile_extent - WEB_MERCATOR_ORIGIN,
+        WEB_MERCATOR_ORIGIN - y0 * tile_extent,
+        tile_extent / TILE_SIZE,
+        tile_extent / TILE_SIZE,
+    )
+
+    src = rasterio.open(file_path)
+    if src.count == 4:
+        # band 4 is alpha, 255 is opaque, so the nodata value set on every band must not apply
+        alpha_options = {'src_alpha': 4, 'src_nodata': None, 'nodata': None}
+    else:
+        alpha_options = {'add_alpha': True}
+
+    vrt = WarpedVRT(
+        src,
+        crs=WEB_MERCATOR,
+        transform=transform,
+        width=(x1 - x0 + 1) * TILE_SIZE,
+        height=(y1 - y0 + 1) * TILE_SIZE,
+        resampling=Resampling.nearest,
+        **alpha_options,
+    )
+
+    __tile_source.update({
+        'src': src,
+        'vrt': vrt,
+        'tile_origin': (x0, y0),
+        'bounds': bounds,
+        'max_zoom': max_zoom,
+        'chunk_zoom': chunk_zoom,
+    })
+
+
+def __render_chunk(chunk):
+
+    source = __tile_source
+    vrt = source['vrt']
+    chunk_x, chunk_y = chunk
+    chunk_size = TILE_SIZE * 2 ** (source['max_zoom'] - source['chunk_zoom'])
+
+    # chunks on the edge of the region only warp the part the VRT covers, the rest is transparent
+    col = (chunk_x * chunk_size) - source['tile_origin'][0] * TILE_SIZE
+    row = (chunk_y * chunk_size) - source['tile_origin'][1] * TILE_SIZE
+    col_start, row_start = max(col, 0), max(row, 0)
+    col_stop, row_stop = min(col + chunk_size, vrt.width), min(row + chunk_size, vrt.height)
+
+    data = np.zeros((4, chunk_size, chunk_size), dtype=np.uint8)
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    data[:, row_start - row:row_stop - row, col_start - col:col_stop - col] = vrt.read(window=window)
+
+    tile_count, pngs = 0, []
+    for zoom in range(source['max_zoom'], source['chunk_zoom'] - 1, -1):
+        if zoom < source['max_zoom']:
+            data = __downsample(data)
+
+        levels = zoom - source['chunk_zoom']
+        x0, y0, x1, y1 = get_tile_range(source['bounds'], zoom)
+        for i in range(2 ** levels):
+            for j in range(2 ** levels):
+                x, y = (chunk_x << levels) + j, (chunk_y << levels) + i
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    tile = data[:, i * TILE_SIZE:(i + 1) * TILE_SIZE, j * TILE_SIZE:(j + 1) * TILE_SIZE]
+                    encoded = __encode_tile(tile, zoom, x, y)
+                    if encoded is not None:
+                        pngs.append(encoded)
+                    tile_count += 1
+
+    return data, tile_count, pngs
+
+
+def __get_parent_tiles(tiles):
+
+    # each parent is its four children averaged down, missing children are transparent
+    canvases = {}
+    for (x, y), tile in tiles.items():
+        parent = (x >> 1, y >> 1)
+        if parent not in canvases:
+            canvases[parent] = np.zeros((4, 2 * TILE_SIZE, 2 * TILE_SIZE), dtype=np.uint8)
+        row, col = (y & 1) * TILE_SIZE, (x & 1) * TILE_SIZE
+        canvases[parent][:, row:row + TILE_SIZE, col:col + TILE_SIZE] = tile
+
+    return {parent: __downsample(canvas) for parent, canvas in canvases.items()}
+
+
+def __downsample(data):
+
+    # 2 x 2 means of RGBA weighted by alpha, so transparent pixels don't darken the edges
+    data = data.astype(np.float32)
+    data[:3] *= data[3]
+    summed = data[:, 0::2, 0::2] + data[:, 0::2, 1::2] + data[:, 1::2, 0::2] + data[:, 1::2, 1::2]
+
+    alpha_sum = summed[3]
+    rgb = np.divide(summed[:3], alpha_sum, out=np.zeros_like(summed[:3]), where=alpha_sum > 0)
+
+    return np.rint(np.concatenate([rgb, alpha_sum[None] / 4])).astype(np.uint8)
+
+
+class __TilePublisher:
+
+    # passes each tile on to write_tile unless its bytes match an earlier tile's, duplicates
+    # (mostly solid colour) are only recorded as aliases of the first tile with those bytes
+
+    def __init__(self, write_tile, deduplicate=True):
+
+        self.write_tile = write_tile
+        self.deduplicate = deduplicate
+        self.paths_by_hash = {}
+        self.aliases = {}
+        self.published_count = 0
+
+    def publish(self, tile_path, png):
+
+        tile_hash = hashlib.sha1(png).hexdigest() if self.deduplicate else None
+        if tile_hash in self.paths_by_hash:
+            self.aliases[tile_path] = self.paths_by_hash[tile_hash]
+            return
+
+        if self.deduplicate:
+            self.paths_by_hash[tile_hash] = tile_path
+        self.write_tile(tile_path, png)
+        self.published_count += 1
+
+
+def __parse_tile_path(tile_path):
+
+    # (zoom, x, y) with y counted from the north again, as PMTiles expects
+    zoom, x, y = (int(part) for part in tile_path[:-len('.png')].split('/'))
+    return zoom, x, 2 ** zoom - 1 - y
+
+
+def __encode_tile(tile, zoom, x, y):
+
+    # (tile path, png), or None for a fully transparent tile.
+    # gdal2tiles numbered rows from the south, and the map clients still expect that
+    if not tile[3].any():
+        return None
+
+    return f'{zoom}/{x}/{2 ** zoom - 1 - y}.png', __encode_png(tile)
+
+
+def __write_file(tiles_dir, tile_path, png):
+
+    os.makedirs(os.path.dirname(f'{tiles_dir}/{tile_path}'), exist_ok=True)
+    with open(f'{tiles_dir}/{tile_path}', 'wb') as f:
+        f.write(png)
+
+
+def __encode_png(tile):
+
+    with warnings.catch_warnings():
+        # tiles carry no georeferencing
+        warnings.simplefilter('ignore', rasterio.errors.NotGeoreferencedWarning)
+        with MemoryFile() as memfile:
+            with memfile.open(driver='PNG', width=tile.shape[2], height=tile.shape[1], count=tile.shape[0], dtype='uint8') as dst:
+                dst.write(tile)
+            return memfile.read()
@@ -0,0 +1,62 @@
+import numpy as np
+from rasterio.windows import Window
+
+
+def get_tile_windows(height, width, tile_size, halo=0):
+    """
+    Yields (core_window, read_window) pairs that cover a raster in row-major order.
+    Core windows don't overlap, read windows extend them by halo pixels on every side,
+    clipped to the raster.
+    """
+
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+
+            core_height = min(tile_size, height - row)
+            core_width = min(tile_size, width - col)
+            core = Window(col, row, core_width, core_height)
+
+            row_start, col_start = max(row - halo, 0), max(col - halo, 0)
+            row_stop = min(row + core_height + halo, height)
+            col_stop = min(col + core_width + halo, width)
+            read = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+            yield core, read
+
+
+def get_core_slices(core, read):
+    """
+    Row and column slices that crop an array read with the read window back to the core window.
+    """
+
+    row_off = int(core.row_off - read.row_off)
+    col_off = int(core.col_off - read.col_off)
+    return slice(row_off, row_off + int(core.height)), slice(col_off, col_off + int(core.width))
+
+
+def pad_to_multiple(data, multiple=32):
+    """
+    Reflect-pads the last two axes of a (bands, height, width) array for the UNet encoders.
+    Like the original padding, a full extra block is added when a side is already a multiple.
+    """
+
+    height_pad = multiple - (data.shape[-2] % multiple)
+    width_pad = multiple - (data.shape[-1] % multiple)
+    pad_width = [(0, 0)] * (data.ndim - 2) + [(0, height_pad), (0, width_pad)]
+
+    return np.pad(data, pad_width, mode='reflect')
+
+
+def pad_to_shape(data, height, width):
+    """
+    Reflect-pads the last two axes of a (bands, height, width) array on the bottom and right
+    up to height and width.
+    """
+
+    pad_width = [(0, 0)] * (data.ndim - 2) + [(0, height - data.shape[-2]), (0, width - data.shape[-1])]
+
+    return np.pad(data, pad_width, mode='reflect')
+
+
+def round_up_to_multiple(value, multiple=32):
+    return -(-value // multiple) * multiple
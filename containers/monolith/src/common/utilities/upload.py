@@ -1,7 +1,8 @@
 import os
 
 from common.aws import s3 as s3_utils
-from common.constants import DATA_CDN_BASE_URL, S3_DATA_BUCKET
+from common.constants import DATA_CDN_BASE_URL, MAP_TILES_DEDUPLICATE, MAP_TILES_FORMAT, S3_DATA_BUCKET
+from common.utilities.tiles import TILES_MANIFEST_NAME, create_map_tiles, create_map_tiles_archive
 
 
 def get_file_cdn_url(file_name):
@@ -9,9 +10,26 @@ def get_file_cdn_url(file_name):
 
 
 def get_tiles_cdn_url(s3_dir):
+
+    # a PMTiles archive is a single object, clients read its tiles with range requests
+    if s3_dir.endswith('.pmtiles'):
+        return f'{DATA_CDN_BASE_URL}/{s3_dir}'
+
     return f'{DATA_CDN_BASE_URL}/{s3_dir}' + '/{z}/{x}/{y}.png'
 
 
+def get_tiles_manifest_cdn_url(s3_dir):
+    """
+    The manifest mapping tiles with duplicate content to their shared copy, see tiles.create_map_tiles.
+    None unless the pyramid has one, which takes MAP_TILES_DEDUPLICATE and a png pyramid.
+    """
+
+    if not MAP_TILES_DEDUPLICATE or s3_dir.endswith('.pmtiles'):
+        return None
+
+    return f'{DATA_CDN_BASE_URL}/{s3_dir}/{TILES_MANIFEST_NAME}'
+
+
 def save_task_file_to_s3(file_path, task_uid, bucket=S3_DATA_BUCKET, subdir=None):
     """
     Save a a task file to S3. This includes TIFs and matplotlib plots.
@@ -46,12 +64,38 @@ def save_task_tiles_to_s3(tiles_dir, task_uid, bucket=S3_DATA_BUCKET, subdir=Non
     
     print(f'uploading {tiles_dir} to s3://{bucket}/{object_base}')
 
+    items = []
     for root, dirs, files in os.walk(tiles_dir):
         for file in files:
             file_path = os.path.join(root, file)
             sub_path = file_path.replace(tiles_dir, '')
-            object_key = f'{object_base}{sub_path}'
-            s3_utils.put_item(file_path, bucket, object_key)
+            items.append((file_path, f'{object_base}{sub_path}'))
+
+    s3_utils.put_items(items, bucket)
 
     return object_base
 
+
+def create_task_tiles_on_s3(file_path, dir_name, task_uid, bucket=S3_DATA_BUCKET, subdir=None, tiles_format=MAP_TILES_FORMAT, **tile_options):
+    """
+    Renders map tiles from file_path straight to S3 under the task, each tile uploaded while the
+    rest are still rendering, so the pyramid never sits on disk. Returns the tiles' S3 directory,
+    as save_task_tiles_to_s3 does. With tiles_format 'pmtiles' the pyramid is written to a single
+    <dir_name>.pmtiles archive next to file_path and uploaded as one object, whose key is returned.
+    """
+
+    if tiles_format == 'pmtiles':
+        archive_path = create_map_tiles_archive(file_path, f'{os.path.dirname(file_path)}/{dir_name}.pmtiles', **tile_options)
+        return save_task_file_to_s3(archive_path, task_uid, bucket=bucket, subdir=subdir)
+
+    if subdir is None:
+        object_base = f'tasks/{task_uid}/{dir_name}'
+    else:
+        object_base = f'tasks/{task_uid}/{subdir}/{dir_name}'
+
+    print(f'streaming tiles to s3://{bucket}/{object_base}')
+
+    with s3_utils.S3Uploader(bucket) as uploader:
+        create_map_tiles(file_path, write_tile=lambda tile_path, png: uploader.put(png, f'{object_base}/{tile_path}'), **tile_options)
+
+    return object_base
@@ -1,3 +1,4 @@
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import rasterio
 
@@ -5,9 +6,10 @@ import rasterio
 
 def save_image(data, dst_path, cmap, vmin, vmax):
 
-    plt.imshow(data, cmap=cmap, interpolation="nearest", vmin=vmin, vmax=vmax)
-    plt.savefig(dst_path)
-    plt.clf()
+    # a figure of its own rather than pyplot's current one, so stages can plot from several threads
+    fig = Figure()
+    fig.subplots().imshow(data, cmap=cmap, interpolation="nearest", vmin=vmin, vmax=vmax)
+    fig.savefig(dst_path)
 
 
 def plot_tif(tif_path, dst_path, bands=1, cmap="RdYlGn", vmin=None, vmax=None):
@@ -9,13 +9,16 @@ import time
 from common.exceptions import EmptyCollectionException, IncompleteCoverageException, NotEnoughItemsException
 from common.constants import DAYS_BUFFER
 from common.utilities.api import get_demo_classification_task, update_demo_classification_task, update_task_status
+from common.utilities.dag import run_stages, stage
 from common.utilities.download import get_cloud_freeish_collection, get_processed_composite
 from common.utilities.email import send_success_email
-from common.utilities.imagery import create_map_tiles, create_rgb_byte_tif_from_composite, create_rgb_byte_tif_from_landcover
+from common.utilities.imagery import create_rgb_byte_tifs_from_composite, create_rgb_byte_tifs_from_landcover
+from common.utilities.models import get_model_metrics
 from common.utilities.prediction import apply_landcover_classification, calculate_landcover_statistics
+from common.utilities.profiling import RunReport, get_raster_pixels
 from common.utilities.projections import reproject_shape
-from common.utilities.upload import get_file_cdn_url, get_tiles_cdn_url, save_task_file_to_s3, save_task_tiles_to_s3
-from common.utilities.visualization import plot_tif
+from common.utilities.stac import get_cache_stats
+from common.utilities.upload import create_task_tiles_on_s3, get_file_cdn_url, get_tiles_cdn_url, get_tiles_manifest_cdn_url, save_task_file_to_s3
 
 
 CLOUD_DETECTION_MODEL_PATH = "./common/models/cloud_detection_model_resnet18_dice_20230327.pth"
@@ -23,6 +26,9 @@ LANDCOVER_CLASSIFICATION_MODEL_PATH = "./common/models/landcover_classification_
 
 TILE_ZOOM = 14
 
+# concurrent S3 file uploads between stages, tile uploads are pooled inside their own stages
+STAGE_UPLOAD_SLOTS = 2
+
 sentry_sdk.init(
     dsn=f"https://c2321cc79562459cb4cfd3d33ac91d3d@o4504860083224576.ingest.sentry.io/{os.environ['SENTRY_MONOLITH_PROJECT_ID']}",
     traces_sample_rate=1.0,
@@ -35,7 +41,7 @@ TASK_UID = os.environ['TASK_UID'].strip()
 TASK_TYPE = os.environ['TASK_TYPE'].strip()
 
 
-def handle():
+def handle(report):
 
     base_dir = f"/tmp/{TASK_UID}"
 
@@ -73,6 +79,7 @@ def handle():
 
         region_ea = reproject_shape(region, "EPSG:4326", "EPSG:3857")
         region_area_km2 = round(region_ea.area / 1000000, 2)
+        report.set_context(area_km2=region_area_km2)
         intro_message = f'intro - task_uid: {TASK_UID}\ndates: {date_start} to {date_end}\narea: {region_area_km2} km2'
         sentry_sdk.capture_message(intro_message, "info")
         print(intro_message)
@@ -82,7 +89,8 @@ def handle():
 
         collection_path = f'{base_dir}/s2_collection.json'
         try:
-            collection = get_cloud_freeish_collection(date_start, date_end, bbox, collection_path)
+            with report.stage('selection'):
+                collection = get_cloud_freeish_collection(date_start, date_end, bbox, collection_path)
         except (EmptyCollectionException, IncompleteCoverageException, NotEnoughItemsException) as e:
             update_task_status(TASK_UID, TASK_TYPE, "failed", "Task failed", "There are not enough valid images for the selected date and region. This usually occurs when there is excessive cloud cover. Please try again with a different date or region.")
             return
@@ -93,7 +101,7 @@ def handle():
         update_task_status(TASK_UID, TASK_TYPE, "running", "Processing imagery")
 
         try:
-            composite_path = get_processed_composite(collection, bbox, base_dir, CLOUD_DETECTION_MODEL_PATH)
+            composite_path = get_processed_composite(collection, bbox, base_dir, CLOUD_DETECTION_MODEL_PATH, report=report)
         except NotEnoughItemsException as e:
             print(e)
             update_task_status(TASK_UID, TASK_TYPE, "failed", "Task failed", "There are not enough valid images for the selected date and region. This usually occurs when there is excessive cloud cover. Please try again with a different date or region.")
@@ -101,53 +109,55 @@ def handle():
         
         print('composite_path', composite_path)
 
-        rgb_path = f'{base_dir}/rgb_byte.tif'
-        create_rgb_byte_tif_from_composite(composite_path, rgb_path, is_cog=True, use_alpha=False)
+        composite_pixels = get_raster_pixels(composite_path)
 
+        rgb_path = f'{base_dir}/rgb_byte.tif'
         rgba_path = f'{base_dir}/rgba_byte.tif'
-        create_rgb_byte_tif_from_composite(composite_path, rgba_path, is_cog=True, use_alpha=True)
-        
-        tiles_dir = f'{base_dir}/rgb_byte_tiles'
-        create_map_tiles(rgba_path, tiles_dir, max_zoom=TILE_ZOOM)
-
         rgb_plot = f'{base_dir}/rgb.png'
-        plot_tif(rgb_path, rgb_plot, bands=[1, 2, 3], cmap=None)
 
-
-        ### model predictions ###
-                
         landcover_path = f'{base_dir}/landcover.tif'
-        apply_landcover_classification(composite_path, landcover_path, LANDCOVER_CLASSIFICATION_MODEL_PATH)
-
-        statistics = calculate_landcover_statistics(landcover_path)
-
         landcover_rgb_path = f'{base_dir}/landcover_rgb_byte.tif'
-        create_rgb_byte_tif_from_landcover(landcover_path, landcover_rgb_path, is_cog=True, use_alpha=False)
-
         landcover_rgba_path = f'{base_dir}/landcover_rgba_byte.tif'
-        create_rgb_byte_tif_from_landcover(landcover_path, landcover_rgba_path, is_cog=True, use_alpha=True)
+        landcover_rgb_plot = f'{base_dir}/landcover.png'
 
-        landcover_tiles_dir = f'{base_dir}/landcover_rgb_byte_tiles'
-        create_map_tiles(landcover_rgba_path, landcover_tiles_dir, max_zoom=TILE_ZOOM)
+        def upload_rgb():
+            save_task_file_to_s3(rgb_plot, TASK_UID) # for debugging purposes
+            return save_task_file_to_s3(rgb_path, TASK_UID)
+
+        def upload_landcover():
+            # the imagery uploads run in the background from the start, this one follows inference
+            update_task_status(TASK_UID, TASK_TYPE, "running", "Uploading assets")
+            save_task_file_to_s3(landcover_rgb_plot, TASK_UID)
+            return save_task_file_to_s3(landcover_rgb_path, TASK_UID)
 
-        landcover_rgb_plot = f'{base_dir}/landcover.png'
-        plot_tif(landcover_rgb_path, landcover_rgb_plot, bands=[1, 2, 3], cmap=None)
-        
 
-        ### upload assets to S3 ###
+        ### render, predict and upload ###
 
-        update_task_status(TASK_UID, TASK_TYPE, "running", "Uploading assets")
+        # the imagery branch only needs the composite, so it runs alongside the landcover branch,
+        # which is declared first as the longer one
+        update_task_status(TASK_UID, TASK_TYPE, "running", "Classifying landcover")
 
-        # imagery
-        save_task_file_to_s3(rgb_plot, TASK_UID) # for debugging purposes
-        rgb_object_key = save_task_file_to_s3(rgb_path, TASK_UID)
-        composite_object_key = save_task_file_to_s3(composite_path, TASK_UID)
-        tiles_s3_dir = save_task_tiles_to_s3(tiles_dir, TASK_UID)
+        # inference and tiling run their own threads and processes, one cpu is left for renders and plots
+        cpus = os.cpu_count()
+        pool_cpus = max(cpus - 1, 1)
+        results = run_stages([
+            # landcover
+            stage('inference', lambda: apply_landcover_classification(composite_path, landcover_path, LANDCOVER_CLASSIFICATION_MODEL_PATH), uses={'cpu': pool_cpus}, pixels=composite_pixels),
+            stage('stats', lambda class_counts: calculate_landcover_statistics(landcover_path, class_counts), inputs=['inference'], uses={'cpu': 1}, pixels=composite_pixels),
+            stage('landcover_render', lambda: create_rgb_byte_tifs_from_landcover(landcover_path, landcover_rgb_path, landcover_rgba_path, landcover_rgb_plot, is_cog=True), after=['inference'], uses={'cpu': 1}, pixels=composite_pixels),
+            stage('landcover_tiles', lambda: create_task_tiles_on_s3(landcover_rgba_path, 'landcover_rgb_byte_tiles', TASK_UID, max_zoom=TILE_ZOOM), after=['landcover_render'], uses={'cpu': pool_cpus}, pixels=composite_pixels),
+            stage('landcover_upload', upload_landcover, after=['landcover_render'], uses={'network': 1}),
 
-        # landcover
-        save_task_file_to_s3(landcover_rgb_plot, TASK_UID)
-        landcover_rgb_object_key = save_task_file_to_s3(landcover_rgb_path, TASK_UID)
-        landcover_tiles_s3_dir = save_task_tiles_to_s3(landcover_tiles_dir, TASK_UID)
+            # imagery
+            stage('rgb_render', lambda: create_rgb_byte_tifs_from_composite(composite_path, rgb_path, rgba_path, rgb_plot, is_cog=True), uses={'cpu': 1}, pixels=composite_pixels),
+            stage('tiles', lambda: create_task_tiles_on_s3(rgba_path, 'rgb_byte_tiles', TASK_UID, max_zoom=TILE_ZOOM), after=['rgb_render'], uses={'cpu': pool_cpus}, pixels=composite_pixels),
+            stage('composite_upload', lambda: save_task_file_to_s3(composite_path, TASK_UID), uses={'network': 1}),
+            stage('rgb_upload', upload_rgb, after=['rgb_render'], uses={'network': 1}),
+        ], limits={'cpu': cpus, 'network': STAGE_UPLOAD_SLOTS}, report=report)
+
+        statistics = results['stats']
+        tiles_s3_dir, landcover_tiles_s3_dir = results['tiles'], results['landcover_tiles']
+        composite_object_key, rgb_object_key, landcover_rgb_object_key = results['composite_upload'], results['rgb_upload'], results['landcover_upload']
 
 
         ### update task in database ###
@@ -155,8 +165,10 @@ def handle():
         rgb_tif_href = get_file_cdn_url(rgb_object_key)
         imagery_tif_href = get_file_cdn_url(composite_object_key)
         imagery_tiles_href = get_tiles_cdn_url(tiles_s3_dir)
+        imagery_tiles_manifest_href = get_tiles_manifest_cdn_url(tiles_s3_dir)
 
         landcover_tiles_href = get_tiles_cdn_url(landcover_tiles_s3_dir)
+        landcover_tiles_manifest_href = get_tiles_manifest_cdn_url(landcover_tiles_s3_dir)
         landcover_rgb_tif_href = get_file_cdn_url(landcover_rgb_object_key)
         
         print(rgb_tif_href)
@@ -171,8 +183,10 @@ def handle():
             statistics_json=json.dumps(statistics),
             imagery_tif_href=imagery_tif_href,
             imagery_tiles_href=imagery_tiles_href,
+            imagery_tiles_manifest_href=imagery_tiles_manifest_href,
             landcover_tif_href=landcover_rgb_tif_href,
             landcover_tiles_href=landcover_tiles_href,
+            landcover_tiles_manifest_href=landcover_tiles_manifest_href,
             rgb_tif_href=rgb_tif_href,
         )
 
@@ -193,16 +207,28 @@ if __name__ == "__main__":
 
     sentry_sdk.set_tag("task_uid", TASK_UID)
 
+    report = RunReport(TASK_UID, TASK_TYPE)
+
+    with sentry_sdk.start_transaction(op="task", name=TASK_TYPE):
+        try:
+            start_time = time.time()
+            handle(report)
+        except Exception as e:
+            print(e)
+            update_task_status(TASK_UID, TASK_TYPE, "failed", "Task failed", "An unexpected error occurred. Please try again later.")
+            sentry_sdk.capture_exception(e)
+        else:
+            end_time = time.time()
+            elapsed_time = end_time - start_time
+            complete_message = f'complete - task_uid: {TASK_UID}\nelapsed time: {elapsed_time:.2f} seconds\n{report.get_summary()}'
+            sentry_sdk.capture_message(complete_message, "info")
+            print(complete_message)
+
+    # saved for failed tasks too, they are the ones worth looking at
     try:
-        start_time = time.time()
-        handle()
+        report.set_context(models=get_model_metrics(), stac_cache=get_cache_stats())
+        report_path = report.save(f'/tmp/{TASK_UID}/run_report.json')
+        save_task_file_to_s3(report_path, TASK_UID)
     except Exception as e:
         print(e)
-        update_task_status(TASK_UID, TASK_TYPE, "failed", "Task failed", "An unexpected error occurred. Please try again later.")
         sentry_sdk.capture_exception(e)
-    else:
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        complete_message = f'complete - task_uid: {TASK_UID}\nelapsed time: {elapsed_time:.2f} seconds'
-        sentry_sdk.capture_message(complete_message, "info")
-        print(complete_message)